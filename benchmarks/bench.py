@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""Benchmarks for the hub's hot paths, run against the simulated pigpio in
+   piwaverf/sim.py so no Pi is needed. Results are written as JSON, and can be
+   checked against a previous run with --baseline."""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'piwaverf'))
+
+import lwrf
+import piwaverf
+import sim
+
+
+TX_GPIO = 18
+RX_GPIO = 24
+TRANSMITTER_ID = 'f1234'
+
+MESSAGES = [
+  b'1,!R1D1F1|Lounge|Lamp on',
+  b'2,!R1D2F0|Lounge|Lamp off',
+  b'3,!R2D3FdP16|Kitchen|Dim 50%',
+  b'4,!R3Fa|Hall|All off',
+  b'5,!R4FmP2|Bedroom|Mood 2',
+  b'6,!R1D1F1!R1D2F1!R1D3FdP8|Lounge|Scene',
+  b':a1:b2:c3:d4:e6:f6,7,!R5D4F1',
+]
+
+BENCHMARKS = ['parse', 'build', 'receive', 'end-to-end']
+
+COMMANDS = [
+  (1, 1, piwaverf.LightCommand.On, None),
+  (1, 2, piwaverf.LightCommand.Off, None),
+  (2, 3, piwaverf.LightCommand.Dim, 16),
+  (3, None, piwaverf.LightCommand.AllOff, None),
+  (4, None, piwaverf.LightCommand.Mood, 2),
+]
+
+
+def percentile(ordered, fraction):
+  """Nearest-rank percentile of an already sorted list."""
+  index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+  return ordered[index]
+
+
+def summarise(samples, unit, **extra):
+  ordered = sorted(samples)
+  result = {
+    'unit': unit,
+    'samples': len(ordered),
+    'mean': sum(ordered) / len(ordered),
+    'min': ordered[0],
+    'p50': percentile(ordered, 0.50),
+    'p90': percentile(ordered, 0.90),
+    'p99': percentile(ordered, 0.99),
+    'max': ordered[-1],
+  }
+  result.update(extra)
+  return result
+
+
+def timed(func, items, iterations):
+  """Calls func on each item iterations times, returning per-call times in
+     microseconds and the overall calls per second."""
+  samples = []
+  clock = time.perf_counter_ns
+  start = clock()
+  for i in range(iterations):
+    for item in items:
+      before = clock()
+      func(item)
+      samples.append((clock() - before) / 1000)
+  elapsed = (clock() - start) / 1e9
+  return samples, len(samples) / elapsed
+
+
+class _DiscardQueue:
+
+  def submit(self, command):
+    pass
+
+
+def bench_parse(iterations):
+  """Hub._handle_message on a mix of single, room-level and batch commands."""
+  hub = piwaverf.Hub(None)
+  hub._queue = _DiscardQueue()
+  samples, rate = timed(hub._handle_message, MESSAGES, iterations)
+  return summarise(samples, 'us', ops_per_second=rate)
+
+
+def bench_build(iterations):
+  """Controller._radio_message and lwrf.tx pulse list construction for one message."""
+  controller = piwaverf.Controller(TRANSMITTER_ID, tx_gpio_pin=TX_GPIO, pi=sim.SimulatedPi(clock=sim.VirtualClock(None)))
+  pulses = controller._tx._pulses
+
+  def build(command):
+    pulses(controller._radio_message(*command))
+
+  samples, rate = timed(build, COMMANDS, iterations)
+  controller._tx.cancel()
+  return summarise(samples, 'us', ops_per_second=rate)
+
+
+def synthetic_edges(repeat, noise, jitter):
+  """Edges on the receive GPIO from transmitting each command, as (level, tick) pairs."""
+  pi = sim.SimulatedPi(links={TX_GPIO: RX_GPIO}, clock=sim.VirtualClock(None), noise=noise, jitter=jitter, seed=1)
+  edges = []
+  pi.callback(RX_GPIO, lwrf.pigpio.EITHER_EDGE, lambda gpio, level, tick: edges.append((level, tick)))
+  controller = piwaverf.Controller(TRANSMITTER_ID, tx_gpio_pin=TX_GPIO, pi=pi)
+  for command in COMMANDS:
+    controller._tx.put(controller._radio_message(*command), repeat)
+  controller._tx.cancel()
+  return edges
+
+
+def bench_receive(edges, iterations, chunk=1000):
+  """lwrf.rx._cb over an edge stream, timed in chunks of edges."""
+  pi = sim.SimulatedPi(clock=sim.VirtualClock(None))
+  receiver = lwrf.rx(pi, RX_GPIO, 0, queue_size=None, dedup_ttl=0) # every pass repeats the same ticks
+  feed = receiver._cb
+  chunks = [edges[i:i + chunk] for i in range(0, len(edges), chunk)]
+
+  samples = []
+  decoded = 0
+  clock = time.perf_counter_ns
+  start = clock()
+  for i in range(iterations):
+    receiver.lastTick = edges[0][1]
+    receiver.state = lwrf.RX_STATE_IDLE
+    for part in chunks:
+      before = clock()
+      for level, tick in part:
+        feed(RX_GPIO, level, tick)
+      samples.append((clock() - before) / len(part))
+    decoded += len(receiver.messages)
+    receiver.messages.clear()
+  elapsed = (clock() - start) / 1e9
+  receiver.cancel()
+  return summarise(samples, 'ns/edge', edges_per_second=len(edges) * iterations / elapsed,
+                   edges=len(edges), messages_per_pass=decoded // iterations)
+
+
+def _free_port():
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+def bench_end_to_end(requests, use_asyncio, speed):
+  """Latency from a UDP datagram being sent to the hub until its acknowledgement
+     arrives and until the transmission completes."""
+  pi = sim.SimulatedPi(clock=sim.VirtualClock(speed))
+  controller = piwaverf.Controller(TRANSMITTER_ID, tx_gpio_pin=TX_GPIO, pi=pi)
+  rx_port = _free_port()
+  tx_port = _free_port()
+  hub_class = piwaverf.AsyncHub if use_asyncio else piwaverf.Hub
+  hub = hub_class(controller, bind_address='127.0.0.1', rx_port=rx_port, tx_port=tx_port)
+
+  completed = threading.Event()
+  send = hub._send
+  def send_and_signal(queued):
+    send(queued)
+    completed.set()
+  hub._send = send_and_signal
+
+  client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  client.bind(('127.0.0.1', tx_port))
+  client.settimeout(1)
+  server = threading.Thread(target=hub.start, daemon=True)
+  server.start()
+
+  acknowledged = []
+  transmitted = []
+  try:
+    for i in range(requests + 1):
+      message = MESSAGES[i % len(MESSAGES)]
+      completed.clear()
+      reply = None
+      for attempt in range(10): # the hub may still be binding its socket
+        start = time.perf_counter()
+        client.sendto(message, ('127.0.0.1', rx_port))
+        try:
+          reply, _ = client.recvfrom(1024)
+          break
+        except socket.timeout:
+          continue
+      if reply is None:
+        raise RuntimeError('No response from the hub')
+      ack = time.perf_counter()
+      if not reply.split(b',')[1].startswith(b'OK'):
+        raise RuntimeError(f'Hub rejected {message}: {reply}')
+      if not completed.wait(30):
+        raise RuntimeError(f'Transmission of {message} did not complete')
+      done = time.perf_counter()
+      while True: # discard the JSON events
+        client.settimeout(0.05)
+        try:
+          client.recvfrom(1024)
+        except socket.timeout:
+          break
+      client.settimeout(1)
+      if i > 0: # the first request includes setting up the wave cache
+        acknowledged.append((ack - start) * 1000)
+        transmitted.append((done - start) * 1000)
+  finally:
+    if use_asyncio:
+      hub.shutdown()
+    else:
+      client.sendto(b'', ('127.0.0.1', rx_port)) # an empty datagram stops the receive loop
+    server.join(10)
+    if not use_asyncio:
+      hub.shutdown()
+    client.close()
+    controller._tx.cancel()
+    pi.stop()
+
+  return {
+    'hub': hub_class.__name__,
+    'clock_speed': speed,
+    'acknowledged': summarise(acknowledged, 'ms'),
+    'transmitted': summarise(transmitted, 'ms'),
+  }
+
+
+def compare(results, baseline, threshold):
+  """Returns descriptions of the p50s which are more than threshold slower than the baseline."""
+  regressions = []
+  def walk(path, current, previous):
+    if not isinstance(current, dict) or not isinstance(previous, dict):
+      return
+    if 'p50' in current and 'p50' in previous and previous['p50'] > 0:
+      change = current['p50'] / previous['p50'] - 1
+      if change > threshold:
+        regressions.append(f'{path}: p50 {previous["p50"]:.3f} -> {current["p50"]:.3f} {current["unit"]} (+{change:.0%})')
+      return
+    for key, value in current.items():
+      walk(f'{path}.{key}' if path else key, value, previous.get(key))
+  walk('', results['benchmarks'], baseline.get('benchmarks', {}))
+  return regressions
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Benchmark the piwaverf hot paths')
+  parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                      help=f'The benchmarks to run, any of {", ".join(BENCHMARKS)}; all by default')
+  parser.add_argument('-n', '--iterations', type=int, default=2000,
+                      help='Passes over the sample messages for parse and build')
+  parser.add_argument('--receive-iterations', type=int, default=20,
+                      help='Passes over the edge stream for receive')
+  parser.add_argument('--capture', dest='capture_file',
+                      help='Use edges from a capture file (see main.py decode) for receive')
+  parser.add_argument('--noise', type=float, default=0.0,
+                      help='Chance of a glitch after each synthetic edge')
+  parser.add_argument('--jitter', type=float, default=0.0,
+                      help='Standard deviation in microseconds of synthetic edge times')
+  parser.add_argument('--requests', type=int, default=50,
+                      help='UDP requests to time for end-to-end')
+  parser.add_argument('--async', dest='use_asyncio', action='store_true',
+                      help='Use AsyncHub for end-to-end')
+  parser.add_argument('--speed', type=float,
+                      help='Simulated clock speed for end-to-end, by default transmissions take no time')
+  parser.add_argument('-o', '--output', help='Write the JSON results to this file rather than stdout')
+  parser.add_argument('--baseline', help='Compare against the JSON results of a previous run')
+  parser.add_argument('--threshold', type=float, default=0.1,
+                      help='Fractional p50 slowdown reported as a regression')
+  args = parser.parse_args(argv[1:])
+  selected = args.benchmarks or BENCHMARKS
+  unknown = set(selected) - set(BENCHMARKS)
+  if unknown:
+    parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+
+  results = {
+    'timestamp': int(time.time()),
+    'python': platform.python_version(),
+    'implementation': platform.python_implementation(),
+    'machine': platform.machine(),
+    'benchmarks': {},
+  }
+  benchmarks = results['benchmarks']
+
+  # the hub logs every command, which would swamp the results
+  with contextlib.redirect_stdout(io.StringIO()):
+    if 'parse' in selected:
+      benchmarks['parse'] = bench_parse(args.iterations)
+    if 'build' in selected:
+      benchmarks['build'] = bench_build(args.iterations)
+    if 'receive' in selected:
+      if args.capture_file is not None:
+        import capture
+        ticks, levels = capture.read_edges(args.capture_file)
+        edges = list(zip(levels, ticks))
+      else:
+        edges = synthetic_edges(piwaverf.Controller._DEFAULT_TX_REPEAT, args.noise, args.jitter)
+      benchmarks['receive'] = bench_receive(edges, args.receive_iterations)
+    if 'end-to-end' in selected:
+      benchmarks['end-to-end'] = bench_end_to_end(args.requests, args.use_asyncio, args.speed)
+
+  output = json.dumps(results, indent=2)
+  if args.output is not None:
+    Path(args.output).write_text(output + '\n')
+  else:
+    print(output)
+
+  if args.baseline is not None:
+    with open(args.baseline, 'r') as fh:
+      regressions = compare(results, json.load(fh), args.threshold)
+    for regression in regressions:
+      print(f'Regression: {regression}', file=sys.stderr)
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Compares the throughput of Hub._handle_message with the character by character
+   parser it replaced, on the messages from bench.py which both understand. The
+   current hub is timed both with its cache of parsed commands, which the repeated
+   sample messages always hit, and without it, which measures the parser itself."""
+
+import argparse
+import contextlib
+import io
+import json
+import sys
+from dataclasses import dataclass
+
+import bench
+from bench import piwaverf
+from piwaverf import LightCommand, QueuedBatch, QueuedCommand, Response, ResponseStatus
+
+
+@dataclass
+class ParsedCommand:
+  identitifer: int
+  argument: int = 0
+
+
+class LegacyHub(piwaverf.Hub):
+  """The hub with its original parser, for comparison only. The code is as it was
+     before the parser was rewritten, with ParsedCommand copied here, except that
+     it prints nothing; none of the sample messages reached its prints."""
+
+  def _handle_message(self, data):
+    message = data.decode('utf-8')
+
+    transaction_id = ''
+    message_offset = 0
+
+    if message[message_offset] == ':': # MAC prefix, ignore at present
+      while message[message_offset] != ',':
+        message_offset += 1
+      message_offset += 1
+
+    while message[message_offset] != ',':
+      transaction_id += message[message_offset]
+      message_offset += 1
+    if len(transaction_id) == 0:
+      transaction_id = '0'
+
+    if message[message_offset] != ',' and message[message_offset + 1] != '!':
+      return Response(transaction_id, ResponseStatus.ERROR, 1, 'Malformed message')
+    message_offset += 2
+
+    if message[message_offset] == 'F':
+      return Response(transaction_id, ResponseStatus.OK)
+
+    commands = []
+    for segment in message[message_offset:].split('|')[0].split('!'):
+      queued = self._parse_segment(segment)
+      if queued is None:
+        return Response(transaction_id, ResponseStatus.ERROR, error_code=2, error_message='Unrecognised command')
+      commands.append(queued)
+
+    if len(commands) == 1:
+      self._queue.submit(commands[0])
+    else:
+      self._queue.submit(QueuedBatch(commands))
+
+    responses = [Response(transaction_id, ResponseStatus.OK, queued.room_number, queued.device_number, queued.command, queued.argument)
+                 for queued in commands]
+    responses[0].batch = responses[1:]
+    return responses[0]
+
+
+  def _parse_segment(self, segment):
+    if len(segment) > 5 and segment[0] == 'R' and segment[2] == 'D' and segment[4] == 'F':
+      room_number = int(segment[1])
+      device_number = int(segment[3])
+      function = segment[5:]
+    elif len(segment) > 3 and segment[0] == 'R' and segment[2] == 'F':
+      room_number = int(segment[1])
+      device_number = None
+      function = segment[3:]
+    else:
+      return None
+
+    command = self._parse_command(function)
+    if command is None:
+      return None
+    if (device_number is None) != (command.identitifer in (LightCommand.AllOff, LightCommand.Mood)):
+      return None
+    return QueuedCommand(room_number, device_number, command.identitifer, command.argument)
+
+
+  def _parse_command(self, function):
+    if function == '0':
+      return ParsedCommand(LightCommand.Off)
+    elif function == '1':
+      return ParsedCommand(LightCommand.On)
+    elif function.startswith('dP'):
+      dim_level = int(function[2:])
+      return ParsedCommand(LightCommand.Dim, dim_level)
+    elif function == 'a':
+      return ParsedCommand(LightCommand.AllOff)
+    elif function.startswith('mP'):
+      mood = int(function[2:])
+      return ParsedCommand(LightCommand.Mood, mood)
+    return None
+
+
+class _NoCache(dict):
+  """Stands in for Hub._parsed, so that every command is parsed."""
+
+  def __setitem__(self, key, value):
+    pass
+
+
+def run(hub_class, messages, iterations, cached=True):
+  hub = hub_class(None)
+  hub._queue = bench._DiscardQueue()
+  if not cached:
+    hub._parsed = _NoCache()
+  samples, rate = bench.timed(hub._handle_message, messages, iterations)
+  return bench.summarise(samples, 'us', ops_per_second=rate)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Compare the UDP message parser with the original')
+  parser.add_argument('-n', '--iterations', type=int, default=20000,
+                      help='Passes over the sample messages')
+  args = parser.parse_args(argv[1:])
+
+  with contextlib.redirect_stdout(io.StringIO()):
+    legacy = run(LegacyHub, bench.MESSAGES, args.iterations)
+    current = run(piwaverf.Hub, bench.MESSAGES, args.iterations)
+    uncached = run(piwaverf.Hub, bench.MESSAGES, args.iterations, cached=False)
+    views = run(piwaverf.Hub, [memoryview(bytearray(message)) for message in bench.MESSAGES], args.iterations)
+
+  print(json.dumps({
+    'legacy': legacy,
+    'current': current,
+    'current_uncached': uncached,
+    'current_memoryview': views,
+    'speedup': current['ops_per_second'] / legacy['ops_per_second'],
+    'speedup_uncached': uncached['ops_per_second'] / legacy['ops_per_second'],
+  }, indent=2))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,140 @@
+"""Offline decoding of recorded 433MHz edge traces, e.g. logs of pigpio callback
+   arguments. NumPy is used for the batch path when it is installed."""
+
+import lwrf
+
+
+# More raw edges than any message can take, even with glitches
+_MESSAGE_WINDOW = 1024
+
+
+def read_edges(filename, gpio=None):
+  """Reads a text capture, returning (ticks, levels). Each line is either
+     'gpio level tick', as passed to a pigpio callback, or 'tick level'. Fields may be
+     separated by whitespace or commas; blank lines and # comments are skipped.
+     If gpio is given, other GPIOs in a three column capture are ignored."""
+  ticks = []
+  levels = []
+  with open(filename, 'r') as fh:
+    for line in fh:
+      fields = line.split('#', 1)[0].replace(',', ' ').split()
+      if len(fields) == 3:
+        if gpio is not None and int(fields[0]) != gpio:
+          continue
+        level, tick = int(fields[1]), int(fields[2])
+      elif len(fields) == 2:
+        tick, level = int(fields[0]), int(fields[1])
+      elif not fields:
+        continue
+      else:
+        raise ValueError(f'Unrecognised capture line: {line.strip()}')
+      ticks.append(tick)
+      levels.append(level)
+  return ticks, levels
+
+
+def decode_edges(ticks, levels, repeat=0):
+  """Decodes edges, returning a list of (tick, message) pairs. Uses the vectorised
+     path if NumPy is available, otherwise feeds every edge through lwrf.decoder."""
+  try:
+    import numpy
+  except ImportError:
+    return lwrf.decoder(repeat).decode(zip(levels, ticks))
+  return decode_arrays(numpy.asarray(ticks, dtype=numpy.int64), numpy.asarray(levels, dtype=numpy.int8), repeat)
+
+
+def decode_arrays(ticks, levels, repeat=0):
+  """Decodes NumPy arrays of edge ticks and levels.
+
+     Pulse widths are classified for the whole capture at once, and with a repeat
+     count of 0 clean messages are then decoded entirely with array operations.
+     Only message starts that fail those checks are run through the lwrf.decoder
+     state machine, so long stretches of noise cost next to nothing. Unlike the
+     live receiver, a message start that interrupts a partial message is not lost."""
+  import numpy
+
+  pulses = numpy.zeros(len(ticks), dtype=numpy.int64)
+  pulses[1:] = (ticks[1:] - ticks[:-1]) & 0xFFFFFFFF
+  # 0 ignored, 1 short, 2 long, 3 invalid, 4 gap between messages
+  classes = numpy.searchsorted(numpy.array([150, 500, 2000, lwrf.RX_PULSE_MAX + 1]), pulses, side='right')
+
+  # a message starts with a rise after a gap, followed by a short high pulse
+  starts = numpy.flatnonzero((classes == 4) & (levels == 1))
+  starts = starts[starts + 1 < len(ticks)]
+  starts = starts[classes[starts + 1] < 2]
+  ends = numpy.minimum(numpy.append(starts[1:], len(ticks)), starts + _MESSAGE_WINDOW)
+
+  found = []
+  if repeat == 0 and len(starts):
+    clean, fast = _decode_clean(numpy, ticks, levels, classes, starts)
+    found.extend(fast)
+    starts = starts[~clean]
+    ends = ends[~clean]
+
+  decoder = lwrf.decoder(repeat)
+  feed = decoder._cb
+  for start, end in zip(starts.tolist(), ends.tolist()):
+    decoder.state = lwrf.RX_STATE_IDLE
+    decoder.lastTick = int(ticks[start - 1])
+    for level, tick in zip(levels[start:end].tolist(), ticks[start:end].tolist()):
+      feed(None, level, tick)
+      if decoder.state == lwrf.RX_STATE_IDLE:
+        break
+    if decoder.messages:
+      found.append((start, ) + decoder.messages.popleft())
+
+  # ticks wrap, so order by position in the capture
+  found.sort(key=lambda item: item[0])
+  return [(tick, message) for start, tick, message in found]
+
+
+# A message is a start bit, then a start bit and an 8 bit symbol per byte
+_MESSAGE_BITS = 1 + lwrf.MESSAGE_BYTES * 9
+# Each bit boundary a message must split into rises at
+_BOUNDARIES = [1] + [10 + 9 * byte for byte in range(lwrf.MESSAGE_BYTES)]
+
+
+def _decode_clean(numpy, ticks, levels, classes, starts):
+  """Decodes the messages following each start that contain no glitches or
+     malformed pulses. Returns a mask of the starts decoded and their
+     (start, tick, message) triples.
+
+     Every '1' is a short high pulse and a '0' stretches the following low, so the
+     low before each rise is either short, ending a '1', or long, ending a '10'."""
+  width = 2 * _MESSAGE_BITS + 1
+  index = starts[:, None] + numpy.arange(width)
+  inside = index < len(ticks)
+  index = numpy.minimum(index, len(ticks) - 1)
+  edge_classes = classes[index]
+  edge_levels = levels[index]
+
+  rises = edge_classes[:, 2::2]
+  valid = (((rises == 1) | (rises == 2)) & (edge_levels[:, 2::2] == 1) & inside[:, 2::2] &
+           (edge_classes[:, 1:-1:2] == 1) & (edge_levels[:, 1:-1:2] == 0))
+
+  lengths = numpy.where(rises == 2, 2, 1)
+  ends = numpy.cumsum(lengths, axis=1)
+  done = numpy.argmax(ends >= _MESSAGE_BITS, axis=1)
+  needed = numpy.arange(_MESSAGE_BITS)[None, :] <= done[:, None]
+  clean = numpy.all(valid | ~needed, axis=1)
+  for boundary in _BOUNDARIES:
+    clean &= numpy.any(ends == boundary, axis=1)
+
+  rows = numpy.flatnonzero(clean)
+  if not len(rows):
+    return clean, []
+
+  bit_starts = (ends - lengths)[rows]
+  bits = numpy.zeros((len(rows), _MESSAGE_BITS + 1), dtype=numpy.uint16)
+  row_index = numpy.broadcast_to(numpy.arange(len(rows))[:, None], bit_starts.shape)
+  in_message = bit_starts < _MESSAGE_BITS
+  bits[row_index[in_message], bit_starts[in_message]] = 1
+
+  weights = (1 << numpy.arange(7, -1, -1)).astype(numpy.uint16)
+  symbol_columns = numpy.array([[2 + 9 * byte + bit for bit in range(8)] for byte in range(lwrf.MESSAGE_BYTES)])
+  symbols = (bits[:, symbol_columns] * weights).sum(axis=2)
+  nibbles = numpy.array(lwrf._NIBBLE, dtype=numpy.uint8)[symbols]
+
+  complete = ticks[index[rows, 2 * (done[rows] + 1)]]
+  return clean, [(start, tick, bytes(message))
+                 for start, tick, message in zip(starts[rows].tolist(), complete.tolist(), nibbles.tolist())]
@@ -0,0 +1,41 @@
+"""Sends commands to a running listen daemon over its Unix control socket, which
+   accepts the same messages as the UDP protocol. Needs neither pigpio nor a
+   transmitter of its own."""
+
+import itertools
+import os
+import socket
+
+
+DEFAULT_CONTROL_SOCKET = '/tmp/piwaverf.sock'
+DEFAULT_TIMEOUT = 2.0
+
+_transaction_ids = itertools.count(1)
+
+
+def submit(command, path=DEFAULT_CONTROL_SOCKET, timeout=DEFAULT_TIMEOUT):
+  """Sends a command such as '!R1D5F1' to the daemon listening on path, returning its
+     reply, e.g. '1,OK', or None if no daemon is listening. Raises socket.timeout if
+     the daemon does not reply in time, and PermissionError if the socket's mode and
+     group do not allow this user to write to it."""
+  transaction_id = (os.getpid() * 1000 + next(_transaction_ids)) % 1000000
+  return _request(f'{transaction_id},{command}', path, timeout)
+
+
+def query(name='@stats', path=DEFAULT_CONTROL_SOCKET, timeout=DEFAULT_TIMEOUT):
+  """Sends a query such as '@stats' to the daemon, returning its reply as for submit()."""
+  return _request(name, path, timeout)
+
+
+def _request(message, path, timeout):
+  if not os.path.exists(path):
+    return None
+
+  with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+    s.bind('') # an autobound address, for the daemon to reply to
+    s.settimeout(timeout)
+    try:
+      s.sendto(message.encode('utf-8'), path)
+    except (ConnectionRefusedError, FileNotFoundError):
+      return None # left behind by a daemon which has stopped
+    return s.recv(65536).decode('utf-8')
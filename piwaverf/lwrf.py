@@ -16,6 +16,10 @@ https://raw.githubusercontent.com/roberttidey/LightwaveRF/master/Raspberry/pytho
 
 # 2020-05-11 - minor changes for Python 3 compatibility
 
+import array
+import asyncio
+import collections
+import threading
 import time
 import pigpio
 
@@ -26,85 +30,405 @@ RX_STATE_MSGSTARTFOUND = 1
 RX_STATE_BYTESTARTFOUND = 2
 RX_STATE_GETBYTE = 3
 RX_MSG_TIMEOUT = 1000000
+RX_PULSE_MAX = 5000 # longer pulses are gaps between messages
+RX_GLITCH = 100
+RX_QUEUE_SIZE = 64
+RX_DEDUP_TTL = 500000 # microseconds since a message was last heard
+RX_DEDUP_SIZE = 32
 
 TX_HIGH = 280
 TX_LOW = 980
 TX_GAP = 10800
 
+TX_WAVE_CACHE_SIZE = 64
+
 _SYMBOL = [0xF6,0xEE,0xED,0xEB,0xDE,0xDD,0xDB,0xBE,0xBD,0xBB,0xB7,0x7E,0x7D,0x7B,0x77,0x6F]
 
+# nibble -> pulse lengths of its byte start and symbol, alternately high
+# and low with each 0 bit merged into the low before it. Every byte
+# starts high and ends low, so runs never merge across bytes.
+_RUNS = []
+for _s in _SYMBOL:
+   _r = array.array('I', (TX_HIGH, TX_HIGH))
+   for _j in range(8):
+      if _s & (0x80>>_j):
+         _r.extend((TX_HIGH, TX_HIGH))
+      else:
+         _r[-1] += TX_LOW
+   _RUNS.append(_r)
+del _s, _r, _j
+_END_RUNS = array.array('I', (TX_HIGH, TX_HIGH))
+
+# pigpio control blocks for a message waveform, one per level change and
+# per delay plus one to start. Every symbol has six 1 bits, so every
+# message has the same number of pulses.
+_WAVE_CBS = 2 * (len(_RUNS[0]) * MESSAGE_BYTES + 5) + 1
+
+
+# symbol -> nibble, unknown symbols decode as 0. A byte can overrun
+# to 9 bits, which never matches a symbol.
+_NIBBLE = [0] * 512
+for _n, _s in enumerate(_SYMBOL):
+   _NIBBLE[_s] = _n
+del _n, _s
+
+_TIMEOUT = pigpio.TIMEOUT
+
+# pulse width in microseconds -> 0 to ignore, 2 short, 4 long or 8 invalid,
+# the edge level is added to short and long transitions
+_PULSE_TRANS = [0] * 150 + [2] * (500 - 150) + [4] * (2000 - 500) + [8] * (RX_PULSE_MAX + 1 - 2000)
+
 
 def _sym2nibble(symbol):
-   for nibble in range(16):
-      if symbol == _SYMBOL[nibble]:
-         return nibble
+   if 0 <= symbol < len(_NIBBLE):
+      return _NIBBLE[symbol]
    return 0
 
+def encode(data, gap=TX_GAP):
+   """
+   Returns the waveform of a message as an array of pulse lengths in
+   microseconds, alternately low and high starting with the gap.
+   Adjacent periods at the same level are merged, so the length of the
+   array is the number of pulses the waveform needs.
+   """
+   runs = array.array('I', (gap, TX_HIGH, TX_HIGH))
+   for i in data:
+      runs.extend(_RUNS[i & 0x0F])
+   runs.extend(_END_RUNS)
+   return runs
+
+def encode_many(messages, gap=TX_GAP):
+   """
+   Returns encode() of each message, as a list.
+   """
+   return [encode(data, gap) for data in messages]
+
 class tx():
 
-   def __init__(self, pi, txgpio):
+   def __init__(self, pi, txgpio, cache_size=TX_WAVE_CACHE_SIZE, chained=True, clock=time, shared_by=1):
       """
       Instantiate a transmitter with the Pi and the transmit gpio.
+      Up to cache_size message waveforms are kept alive in pigpiod and
+      reused for repeated messages, a cache_size of 0 disables the cache.
+      If chained is True the AGC preamble and all repeats of a message
+      are handed to pigpio as a single wave chain.
+      clock provides monotonic() and sleep(), as the time module does.
+      shared_by is the number of transmitters using the same pigpio
+      daemon, which divide its control blocks between their caches.
+      Every waveform is padded to the same size, so pigpio can reuse a
+      deleted one's control blocks for the next.
       """
       self.pi = pi
       self.txgpio = txgpio
       self.txbit = (1<<txgpio)
-      self.wave_id = None
+      self.wave_ids = []
       self.txBusy = False
+      self.txEnd = 0
+      self.clock = clock
+      self.txTimer = None
+      self.chained = chained
+      self.preamble_id = None
+      self.cacheSize = cache_size
+      self.cache = collections.OrderedDict() # (message, gap) -> (wave id, micros, pulses)
+      self.cachePulses = 0
+      self.lowPulses = {} # micros -> pigpio.pulse, shared by all waveforms
+      self.highPulses = {}
+      self.cacheHits = 0
+      self.cacheMisses = 0
+      self.cacheEvictions = 0
+      self.slotPercent = None # size of every waveform, in percent of pigpio's control blocks
+      self.slots = None # waveforms this transmitter may keep in pigpiod
+      self.sharedBy = shared_by
+      self.lastBuildTime = 0.0 # seconds spent on waveforms by the last put
+      self.lastAirTime = 0.0 # seconds on air of the last put
+      self.lastFrames = 0 # messages transmitted by the last put
       pi.wave_add_new()
       pi.set_mode(txgpio, pigpio.OUTPUT)
 
-   def put(self, data, repeat=1):
+   def put(self, data, repeat=1, callback=None, gap=TX_GAP):
       """
-      Transmit a message repeat times
+      Transmit a message repeat times, each preceded by gap microseconds
+      of silence. Receivers only see a message start after a gap longer
+      than RX_PULSE_MAX.
       0 is returned if message transmission has successfully started.
       Negative number indicates an error.
+      In chained mode put() returns once the burst is complete, unless
+      a callback is given in which case it is called with no arguments
+      on completion and put() returns immediately.
+      """
+      return self.put_many([data], repeat, callback, gap)
+
+   def put_many(self, messages, repeat=1, callback=None, gap=TX_GAP):
+      """
+      Transmit several messages as one burst, interleaving them so
+      each repeat sends every message once (A B C A B C ...).
+      Return value, callback and gap are as for put().
+      """
+      return self.put_interleaved([(data, repeat, gap) for data in messages], callback)
+
+   def put_interleaved(self, frames, callback=None):
+      """
+      Transmit several messages as one burst. frames is a list of
+      (message, repeat, gap) and the messages are sent round robin,
+      each until it has been sent its repeat count (A B C A B C A C),
+      so every message goes out near the start of the burst.
+      Return value and callback are as for put().
+      The time taken to prepare the waveforms, the time on air and the
+      number of frames sent are left in lastBuildTime, lastAirTime and
+      lastFrames.
       """
       ret = 0
-      if len(data) != MESSAGE_BYTES:
+      self.lastBuildTime = 0.0
+      self.lastAirTime = 0.0
+      self.lastFrames = 0
+      if (not frames or any(len(data) != MESSAGE_BYTES or repeat < 1 or
+            gap <= RX_PULSE_MAX for data, repeat, gap in frames)):
          ret = -1
+      elif self.chained:
+         self._stop()
+         ret = self._chain(frames)
+         if ret == 0:
+            if callback is None:
+               self.wait()
+            else:
+               self.txTimer = threading.Timer(
+                  max(0, self.txEnd - self.clock.monotonic()), self._done, (callback,))
+               self.txTimer.start()
       else:
-         self.cancel()
+         self._stop()
          self.txBusy = True
+         start = self.clock.monotonic()
          #Set TX high and wait to get agc of RX trained
          self.pi.write(self.txgpio, 1)
-         time.sleep(TX_GAP / 1000000)
-         #Define a single message waveform
-         self.wf = []
-         # Pre Message low gap
-         self.wf.append(pigpio.pulse(0, self.txbit, TX_GAP))
-         # Message start pulse
-         self.wf.append(pigpio.pulse(self.txbit, 0, TX_HIGH))
-         self.wf.append(pigpio.pulse(0, self.txbit, TX_HIGH))
-         
-         for i in data:
-            # Byte start pulse
-            self.wf.append(pigpio.pulse(self.txbit, 0, TX_HIGH))
-            self.wf.append(pigpio.pulse(0, self.txbit, TX_HIGH))
-            self.byte = _SYMBOL[i & 0x0F]
-            for j in range(8):
-               if self.byte & (0x80>>j):
-                  self.wf.append(pigpio.pulse(self.txbit, 0, TX_HIGH))
-                  self.wf.append(pigpio.pulse(0, self.txbit, TX_HIGH))
-               else:
-                  self.wf.append(pigpio.pulse(0, 0, TX_LOW))
-            
-         # Message end pulse
-         self.wf.append(pigpio.pulse(self.txbit, 0, TX_HIGH))
-         self.wf.append(pigpio.pulse(0, self.txbit, TX_HIGH))
-
-         self.pi.wave_add_generic(self.wf)
-         self.wave_id = self.pi.wave_create()
-         if self.wave_id >= 0:
-            for r in range(repeat):
-               self.pi.wave_send_once(self.wave_id)
-               while self.pi.wave_tx_busy(): # wait for waveform to be sent
-                  time.sleep(0.001)
+         self.clock.sleep(TX_GAP / 1000000)
+         if self._build(frames) is not None:
+            for r in range(max(repeat for data, repeat, gap in frames)):
+               for wave_id, (data, repeat, gap) in zip(self.wave_ids, frames):
+                  if r < repeat:
+                     self.pi.wave_send_once(wave_id)
+                     while self.pi.wave_tx_busy(): # wait for waveform to be sent
+                        self.clock.sleep(0.001)
+            self._release()
+            self.lastAirTime = self.clock.monotonic() - start
+            self.lastFrames = sum(repeat for data, repeat, gap in frames)
          else:
             ret = -2
          self.txBusy = False
+         if callback is not None:
+            callback()
       return ret
 
+   def _chain(self, frames):
+      """
+      Starts the AGC preamble followed by the interleaved messages as
+      one pigpio wave chain. Each run of rounds sending the same
+      messages is a loop, so the chain stays short.
+      """
+      if self.preamble_id is None:
+         self.preamble_id = self._create([pigpio.pulse(self.txbit, 0, TX_GAP)])
+         if self.preamble_id < 0:
+            self.preamble_id = None
+            return -2
+      micros = self._build(frames)
+      if micros is None:
+         return -2
+      chain = [self.preamble_id]
+      airtime = TX_GAP
+      sent = 0
+      for rounds in sorted(set(repeat for data, repeat, gap in frames)):
+         active = [i for i, (data, repeat, gap) in enumerate(frames) if repeat >= rounds]
+         loops = rounds - sent
+         chain += [255, 0] + [self.wave_ids[i] for i in active] + [255, 1, loops & 0xFF, (loops >> 8) & 0xFF]
+         airtime += loops * sum(micros[i] for i in active)
+         sent = rounds
+      self.txBusy = True
+      self.lastAirTime = airtime / 1000000
+      self.lastFrames = sum(repeat for data, repeat, gap in frames)
+      self.txEnd = self.clock.monotonic() + self.lastAirTime
+      self.pi.wave_chain(chain)
+      return 0
+
+   def _build(self, frames):
+      """
+      _waves(), timed into lastBuildTime.
+      """
+      start = time.perf_counter()
+      micros = self._waves(frames)
+      self.lastBuildTime = time.perf_counter() - start
+      return micros
+
+   def _waves(self, frames):
+      """
+      Looks up or creates the waveforms for the (message, repeat, gap)
+      frames of a burst, leaving their ids in wave_ids. Returns the
+      length of each waveform in microseconds, or None if a waveform
+      could not be created.
+      """
+      self.wave_ids = []
+      burst = set((tuple(data), gap) for data, repeat, gap in frames)
+      micros = []
+      for data, repeat, gap in frames:
+         wave_id, wave_micros = self._wave(data, burst, gap)
+         if wave_id < 0:
+            self._release()
+            return None
+         self.wave_ids.append(wave_id)
+         micros.append(wave_micros)
+      return micros
+
+   @staticmethod
+   def micros(data, gap=TX_GAP):
+      """
+      Returns the time on air of one message, in microseconds.
+      """
+      return sum(encode(data, gap))
+
+   def wait(self):
+      """
+      Waits for the current chained burst to finish.
+      """
+      if self.txBusy:
+         delay = self.txEnd - self.clock.monotonic()
+         if delay > 0:
+            self.clock.sleep(delay)
+         while self.pi.wave_tx_busy(): # only if pigpio is running late
+            self.clock.sleep(0.001)
+         self.txBusy = False
+         self._release()
+
+   def _done(self, callback):
+      self.txTimer = None
+      self.wait()
+      callback()
+
+   def _release(self):
+      """
+      Deletes the last burst's waveforms if they are not cached.
+      """
+      if self.cacheSize == 0:
+         for wave_id in self.wave_ids:
+            self.pi.wave_delete(wave_id)
+         self.wave_ids = []
+
+   def _pulses(self, data, gap=TX_GAP):
+      """
+      Returns the pulses of a single message waveform, from encode().
+      """
+      wf = []
+      level = 0
+      pulses = (self.lowPulses, self.highPulses)
+      for micros in encode(data, gap):
+         pulse = pulses[level].get(micros)
+         if pulse is None:
+            if level:
+               pulse = pigpio.pulse(self.txbit, 0, micros)
+            else:
+               pulse = pigpio.pulse(0, self.txbit, micros)
+            pulses[level][micros] = pulse
+         wf.append(pulse)
+         level ^= 1
+      return wf
+
+   def _wave(self, data, keep=(), gap=TX_GAP):
+      """
+      Returns the wave id and length in microseconds for a message,
+      creating the waveform if it is not already cached. Least recently
+      used waveforms other than those in keep are deleted when the cache
+      or this transmitter's share of pigpio's slots is full.
+      Negative wave id indicates an error.
+      """
+      key = (tuple(data), gap)
+      entry = self.cache.get(key)
+      if entry is not None:
+         self.cache.move_to_end(key)
+         self.cacheHits += 1
+         return entry[0], entry[1]
+      self.cacheMisses += 1
+
+      if self.cacheSize > 0:
+         # one slot is left for the preamble
+         while len(self.cache) >= min(self.cacheSize, self._slots() - 1):
+            if not self._evict(keep):
+               break
+
+      wf = self._pulses(data, gap)
+      wave_id = self._create(wf, keep)
+      micros = sum(p.delay for p in wf)
+
+      if wave_id >= 0 and self.cacheSize > 0:
+         self.cachePulses += len(wf)
+         self.cache[key] = (wave_id, micros, len(wf))
+      return wave_id, micros
+
+   def _slots(self):
+      """
+      Returns the number of waveforms this transmitter may keep, each
+      padded to the slotPercent of pigpio's control blocks which fits
+      a message.
+      """
+      if self.slots is None:
+         max_cbs = self.pi.wave_get_max_cbs()
+         self.slotPercent = -(-100 * _WAVE_CBS // max_cbs)
+         self.slots = 100 // self.slotPercent // self.sharedBy
+      return self.slots
+
+   def _create(self, wf, keep=()):
+      """
+      Creates a waveform from pulses, padded to a slot, evicting cached
+      waveforms if pigpio has run out of room for it.
+      """
+      self._slots()
+      while True:
+         try:
+            self.pi.wave_add_generic(wf)
+            wave_id = self.pi.wave_create_and_pad(self.slotPercent)
+         except pigpio.error:
+            wave_id = -1
+         if wave_id >= 0:
+            return wave_id
+         # Out of wave ids or control blocks, make room and try again
+         self.pi.wave_add_new()
+         if not self._evict(keep):
+            return wave_id
+
+   def _evict(self, keep=()):
+      """
+      Deletes the least recently used cached waveform not in keep.
+      Returns False if there was nothing to delete.
+      """
+      for key in self.cache:
+         if key not in keep:
+            wave_id, micros, pulses = self.cache.pop(key)
+            self.pi.wave_delete(wave_id)
+            self.cachePulses -= pulses
+            self.cacheEvictions += 1
+            return True
+      return False
+
+   def _stop(self):
+      """
+      Stops any waveform still being transmitted.
+      """
+      if self.txTimer is not None:
+         self.txTimer.cancel()
+         self.txTimer = None
+      if self.txBusy:
+         self.pi.wave_tx_stop()
+         self.txBusy = False
+         self._release()
+
+   def stats(self):
+      """
+      Returns the waveform cache counters.
+      """
+      return {
+         'hits': self.cacheHits,
+         'misses': self.cacheMisses,
+         'evictions': self.cacheEvictions,
+         'waves': len(self.cache),
+         'slots': self.slots,
+         'pulses': self.cachePulses,
+      }
 
    def ready(self):
       """
@@ -115,125 +439,203 @@ class tx():
    def cancel(self):
       """
       Cancels the wireless transmitter, aborting any message
-      in progress.
+      in progress and deleting all cached waveforms.
       """
-      if self.wave_id is not None:
+      if self.txTimer is not None:
+         self.txTimer.cancel()
+         self.txTimer = None
+      if self.wave_ids or self.cache or self.preamble_id is not None:
          self.pi.wave_tx_stop()
-         self.pi.wave_delete(self.wave_id)
+         self._release()
+         for wave_id, micros, pulses in self.cache.values():
+            self.pi.wave_delete(wave_id)
+         if self.preamble_id is not None:
+            self.pi.wave_delete(self.preamble_id)
          self.pi.wave_add_new()
 
-      self.wave_id = None
+      self.preamble_id = None
+      self.cache.clear()
+      self.cachePulses = 0
+      self.txBusy = False
+      self.wave_ids = []
+
+class decoder():
 
-class rx():
+   __slots__ = ('messages', 'duplicate', 'repeat', 'repeatCount',
+      'messageTick', 'bit', 'byte', 'message', 'state', 'data', 'lastTick',
+      'edges', 'discarded', 'statsTime', 'statsEdges', 'statsDiscarded',
+      'dedupTtl', 'dedupSize', 'recent', 'duplicates')
 
-   def __init__(self, pi, rxgpio, repeat):
+   def __init__(self, repeat=0, queue_size=None, tick=0, dedup_ttl=0, dedup_size=RX_DEDUP_SIZE):
       """
-      Instantiate a LightwaveRF receiver with the Pi, the receive gpio, and
-      Repeat count sets number of identical messages before a report 
-      A repeat count > 0 also filters duplicates
+      Instantiate a LightwaveRF decoder, independent of pigpio.
+      Edges are fed in as (level, tick) pairs, where tick is in
+      microseconds and wraps at 32 bits as pigpio's does.
+      Repeat count is as for rx. At most queue_size unread messages are
+      kept, None for no limit.
+      If dedup_ttl is above 0, a message heard again within dedup_ttl
+      microseconds of its last reception is dropped as a duplicate, so
+      a burst of repeats is reported once even if other transmitters'
+      messages are interleaved with it. The last dedup_size distinct
+      messages are remembered.
       """
-      self.pi = pi
-      self.rxgpio = rxgpio
-      self.messages = []
+      self.messages = collections.deque(maxlen=queue_size)
       self.duplicate = False
       self.repeat = repeat
       self.repeatCount = 0
       self.messageTick = 0
       self.bit = 0
       self.byte = 0
-      self.message = [0]*(MESSAGE_BYTES)
+      self.message = bytearray(MESSAGE_BYTES)
       self.state = RX_STATE_IDLE;
       self.data = 0
+      self.edges = 0
+      self.discarded = 0
+      self.statsTime = time.monotonic()
+      self.statsEdges = 0
+      self.statsDiscarded = 0
+      self.lastTick = tick
+      self.dedupTtl = dedup_ttl
+      self.dedupSize = dedup_size
+      self.recent = collections.OrderedDict() # message -> tick last heard
+      self.duplicates = 0
+
+   def feed(self, level, tick):
+      """
+      Processes one edge.
+      """
+      self._cb(None, level, tick)
 
-      pi.set_mode(rxgpio, pigpio.INPUT)
-      self.lastTick = self.pi.get_current_tick()
-      self.cb = pi.callback(rxgpio, pigpio.EITHER_EDGE, self._cb)
+   def decode(self, edges):
+      """
+      Processes an iterable of (level, tick) edges, then returns and
+      removes all unread (tick, message) pairs.
+      """
+      cb = self._cb
+      for level, tick in edges:
+         cb(None, level, tick)
+      found = list(self.messages)
+      self.messages.clear()
+      return found
 
    def _cb(self, gpio, level, tick):
-      if level != pigpio.TIMEOUT:
-         # Get microseconds since last change
-         pulse = tick - self.lastTick
-         self.lastTick = tick
-         if pulse < 150: #very short pulse so ignore it
+      """
+      The state machine, with the signature of a pigpio callback.
+      """
+      if level == _TIMEOUT:
+         self._timeout()
+         return
+      self.edges += 1
+      # Get microseconds since last change
+      pulse = (tick - self.lastTick) & 0xFFFFFFFF
+      self.lastTick = tick
+      if pulse > RX_PULSE_MAX:
+         trans = level + 6 # gap between messages
+      else:
+         trans = _PULSE_TRANS[pulse]
+         if trans == 0 or self.state == RX_STATE_IDLE:
+            # very short pulse, or not worth proceeding until a gap is seen
+            self.discarded += 1
             return
-         elif self.state == RX_STATE_IDLE and pulse <= 5000: #quick check to see worth proceeding
+         if trans < 8:
+            trans += level
+      state = self.state
+
+      #State machine using nested ifs
+      if state == RX_STATE_IDLE:
+         if trans == 7: # 1 after a message gap
+            self.state = RX_STATE_MSGSTARTFOUND
+            self.duplicate = True
+      elif trans == 2: # nothing to do wait for next 1
+         pass
+      elif state == RX_STATE_GETBYTE:
+         if trans == 3: # 1 160->500
+            data = self.data << 1 | 1
+            bit = self.bit + 1
+         elif trans == 5: # 500 - 1500 a 1 followed by a 0
+            data = self.data << 2 | 2
+            bit = self.bit + 2
+         else:
+            self.state = RX_STATE_IDLE
+            return
+         # Check if byte complete
+         if bit < 8:
+            self.data = data
+            self.bit = bit
+            return
+         # Translate symbols to nibbles and enter message
+         nibble = _NIBBLE[data]
+         byte = self.byte
+         message = self.message
+         if nibble != message[byte]: # Is it same as last packet
+            self.duplicate = False
+            self.repeatCount = 0
+         message[byte] = nibble
+         self.bit = 0
+         byte += 1
+         self.byte = byte
+         if byte < MESSAGE_BYTES:
+            self.state = RX_STATE_BYTESTARTFOUND
             return
-         elif pulse < 500: #normal short pulse
-            trans = level + 2
-         elif pulse < 2000: #normal long pulse
-            trans = level + 4
-         elif pulse > 5000: # gap between messages
-            trans = level + 6
+         # Packet complete
+         if pigpio.tickDiff(self.messageTick, tick) > RX_MSG_TIMEOUT or self.messageTick == 0:
+            # Long time since last message so reset the counter
+            self.repeatCount = 0
+         elif self.duplicate:
+            self.repeatCount +=1
+         if self.repeat == 0 or self.repeatCount == self.repeat:
+            data = bytes(message)
+            if self.dedupTtl <= 0 or self._unseen(data, tick):
+               self._arrive(data, tick)
+         self.state = RX_STATE_IDLE
+         self.messageTick = tick
+      elif state == RX_STATE_BYTESTARTFOUND:
+         if trans == 3: # 1 160->500
+            self.data = 0
+            self.bit = 0
+            self.state = RX_STATE_GETBYTE
+         elif trans == 5: # 0 500->1500 starts with a 0 so enter it
+            self.data = 0
+            self.bit = 1
+            self.state = RX_STATE_GETBYTE
          else:
-            trans = 8
-         #State machine using nested ifs
-         if self.state == RX_STATE_IDLE:
-            if trans == 7: # 1 after a message gap
-               self.state = RX_STATE_MSGSTARTFOUND
-               self.duplicate = True
-         elif self.state == RX_STATE_MSGSTARTFOUND:
-            if trans == 2: # nothing to do wait for next 1
-               trans = trans
-            elif trans == 3: # start of a byte detected
-               self.byte = 0
-               self.state = RX_STATE_BYTESTARTFOUND
-            else:
-               self.state = RX_STATE_IDLE
-         elif self.state == RX_STATE_BYTESTARTFOUND:
-            if trans == 2: # nothing to do wait for next 1
-               trans = trans
-            elif trans == 3: # 1 160->500
-               self.data = 0
-               self.bit = 0
-               self.state = RX_STATE_GETBYTE
-            elif trans == 5: # 0 500->1500 starts with a 0 so enter it
-               self.data = 0
-               self.bit = 1
-               self.state = RX_STATE_GETBYTE
-            else:
-               self.state = RX_STATE_IDLE
-         elif self.state == RX_STATE_GETBYTE:
-            if trans == 2: # nothing to do wait for next 1
-               trans = trans
-            elif trans == 3: # 1 160->500
-               self.data = self.data << 1 | 1
-               self.bit +=1
-            elif trans == 5: # 500 - 1500 a 1 followed by a 0
-               self.data = self.data << 2 | 2
-               self.bit +=2
-            else:
-               self.state = RX_STATE_IDLE
-            # Check if byte complete
-            if self.bit >= 8:
-               # Translate symbols to nibbles and enter message
-               self.data = _sym2nibble(self.data)
-               if self.data != self.message[self.byte]: # Is it same as last packet
-                  self.duplicate = False
-                  self.repeatCount = 0
-               self.message[self.byte] = self.data
-               self.byte +=1
-               self.bit = 0
-               if self.byte >= MESSAGE_BYTES: # Is packet complete
-                  if pigpio.tickDiff(self.messageTick, self.lastTick) > RX_MSG_TIMEOUT or self.messageTick == 0:
-                     # Long time since last message so reset the counter
-                     self.repeatCount = 0
-                  elif self.duplicate:
-                     self.repeatCount +=1
-                  if self.repeat == 0 or self.repeatCount == self.repeat:
-                     self.messages.append(self.message[0:MESSAGE_BYTES])
-                  self.state = RX_STATE_IDLE
-                  self.messageTick = self.messageTick
-               else:
-                  self.state = RX_STATE_BYTESTARTFOUND
-      else:
-         self.pi.set_watchdog(self.rxgpio, 0) # Switch watchdog off.
+            self.state = RX_STATE_IDLE
+      else: # RX_STATE_MSGSTARTFOUND
+         if trans == 3: # start of a byte detected
+            self.byte = 0
+            self.state = RX_STATE_BYTESTARTFOUND
+         else:
+            self.state = RX_STATE_IDLE
+
+   def _unseen(self, data, tick):
+      """
+      Returns False, counting a duplicate, if the message was heard
+      within dedupTtl. Each reception restarts the window, so however
+      long a burst is, only its first message is reported.
+      """
+      recent = self.recent
+      last = recent.pop(data, None)
+      recent[data] = tick
+      if last is not None and pigpio.tickDiff(last, tick) <= self.dedupTtl:
+         self.duplicates += 1
+         return False
+      if len(recent) > self.dedupSize:
+         recent.popitem(last=False)
+      return True
+
+   def _arrive(self, message, tick):
+      self.messages.append((tick, message))
+
+   def _timeout(self):
+      pass
 
    def get(self):
       """
       Returns the next unread message, or None if none is available.
+      Messages from a decoder are (tick, message) pairs.
       """
-      if len(self.messages):
-         return self.messages.pop(0)
+      if self.messages:
+         return self.messages.popleft()
       else:
          return None
 
@@ -243,6 +645,100 @@ class rx():
       """
       return len(self.messages)
 
+   def stats(self):
+      """
+      Returns the edge counters, with per second rates since the
+      previous call.
+      """
+      now = time.monotonic()
+      edges = self.edges
+      discarded = self.discarded
+      elapsed = now - self.statsTime
+      if elapsed > 0:
+         edgeRate = (edges - self.statsEdges) / elapsed
+         discardRate = (discarded - self.statsDiscarded) / elapsed
+      else:
+         edgeRate = discardRate = 0.0
+      self.statsTime = now
+      self.statsEdges = edges
+      self.statsDiscarded = discarded
+      return {
+         'edges': edges,
+         'discarded': discarded,
+         'duplicates': self.duplicates,
+         'edges_per_second': edgeRate,
+         'discarded_per_second': discardRate,
+      }
+
+class rx(decoder):
+
+   __slots__ = ('pi', 'rxgpio', 'cb', 'arrived', 'listeners')
+
+   def __init__(self, pi, rxgpio, repeat, glitch=RX_GLITCH, queue_size=RX_QUEUE_SIZE, dedup_ttl=RX_DEDUP_TTL):
+      """
+      Instantiate a LightwaveRF receiver with the Pi, the receive gpio, and
+      Repeat count sets number of identical messages before a report 
+      A repeat count > 0 also filters duplicates
+      Edges shorter than glitch microseconds are filtered out by pigpio,
+      and at most queue_size unread messages are kept.
+      Duplicates within dedup_ttl microseconds are dropped, as for decoder;
+      0 reports every message.
+      """
+      decoder.__init__(self, repeat, queue_size, pi.get_current_tick(), dedup_ttl)
+      self.pi = pi
+      self.rxgpio = rxgpio
+      self.arrived = threading.Condition()
+      self.listeners = []
+
+      pi.set_mode(rxgpio, pigpio.INPUT)
+      if glitch > 0:
+         pi.set_glitch_filter(rxgpio, glitch)
+      self.cb = pi.callback(rxgpio, pigpio.EITHER_EDGE, self._cb)
+
+   def _arrive(self, message, tick):
+      with self.arrived:
+         self.messages.append(message)
+         self.arrived.notify_all()
+      for listener in self.listeners:
+         listener()
+
+   def __iter__(self):
+      """
+      Yields messages as they arrive, blocking until one is available.
+      Iteration ends when the receiver is cancelled.
+      """
+      while True:
+         with self.arrived:
+            while not self.messages and self.cb is not None:
+               self.arrived.wait()
+            if not self.messages:
+               return
+            message = self.messages.popleft()
+         yield message
+
+   async def __aiter__(self):
+      """
+      Yields messages as they arrive without blocking the event loop.
+      Iteration ends when the receiver is cancelled.
+      """
+      loop = asyncio.get_running_loop()
+      event = asyncio.Event()
+      listener = lambda: loop.call_soon_threadsafe(event.set)
+      self.listeners.append(listener)
+      try:
+         while True:
+            while self.messages:
+               yield self.messages.popleft()
+            if self.cb is None:
+               return
+            await event.wait()
+            event.clear()
+      finally:
+         self.listeners.remove(listener)
+
+   def _timeout(self):
+      self.pi.set_watchdog(self.rxgpio, 0) # Switch watchdog off.
+
    def cancel(self):
       """
       Cancels the wireless receiver.
@@ -250,7 +746,12 @@ class rx():
       if self.cb is not None:
          self.cb.cancel()
          self.pi.set_watchdog(self.rxgpio, 0)
-      self.cb = None
+         self.pi.set_glitch_filter(self.rxgpio, 0)
+      with self.arrived:
+         self.cb = None
+         self.arrived.notify_all()
+      for listener in self.listeners:
+         listener()
 
 """
 Test main routine
@@ -277,13 +778,11 @@ if __name__ == "__main__":
    print("Transmit test sending", TX_TEST, TX_REPEAT, "times")
    tx.put(TX_TEST, TX_REPEAT)
       
-   start = time.time()
-   
-   while (time.time()-start) < 30:
-      if rx.ready():
-         print("Received","".join("%01X" % x for x in rx.get()))
-      time.sleep(0.010)
-   rx.cancel()
+   # Iteration blocks until a message arrives and ends when rx is cancelled
+   threading.Timer(30, rx.cancel).start()
+
+   for message in rx:
+      print("Received","".join("%01X" % x for x in message))
    tx.cancel()
    pi.stop()
    time.sleep(2)
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
-import piwaverf
 import time
 import sys
 import argparse
 import signal
+import socket
+import threading
 from pathlib import Path
 
+import client
+
 
 DEFAULT_TRANSMITTER_ID = 'f1234'
 DEFAULT_MAPPING_FILE = f'{Path.home()}/lightwaverf-config.yml'
@@ -14,26 +17,126 @@ DEFAULT_MAPPING_FILE = f'{Path.home()}/lightwaverf-config.yml'
 
 def main(argv):
   parser = argparse.ArgumentParser(description='Control LightwaveRF lights')
-  parser.add_argument('command', choices=['pair', 'on', 'off', 'listen'],
+  parser.add_argument('command', choices=['pair', 'on', 'off', 'listen', 'decode', 'stats', 'status', 'calibrate', 'profile', 'trace'],
                       help='The action to perform')
   parser.add_argument('-r', '--room', dest='room_name',
-                      help='The name of the room for pair/on/off')
+                      help='The name of the room for pair/on/off/calibrate, or to limit status to')
   parser.add_argument('-d', '--device', dest='device_name',
-                      help='The name of the device for pair/on/off')
+                      help='The name of the device for pair/on/off/calibrate, or to limit status to')
   parser.add_argument('-t', '--transmitter', dest='transmitter',
                       default=DEFAULT_TRANSMITTER_ID, help='The ID of the transmitter')
   parser.add_argument('-m', '--mapping', dest='mapping_file',
                       default=DEFAULT_MAPPING_FILE, help='The mapping file for room/device names to indices')
+  parser.add_argument('--async', dest='use_asyncio', action='store_true',
+                      help='Serve the UDP protocol from an asyncio event loop in listen mode')
+  parser.add_argument('--rx-gpio', dest='rx_gpio', type=int,
+                      help='Broadcast 433MHz messages received on this GPIO in listen mode, or calibrate with them')
+  parser.add_argument('--rx-dedup', dest='rx_dedup', type=float, default=500,
+                      help='Milliseconds within which a received message heard again is not reported, 0 to report every repeat')
+  parser.add_argument('--simulate', dest='simulate', action='store_true',
+                      help='Use an in-process simulation of pigpio instead of the pigpio daemon')
+  parser.add_argument('-f', '--file', dest='capture_file',
+                      help='The edge capture to decode')
+  parser.add_argument('--gpio', dest='capture_gpio', type=int,
+                      help='Only decode edges for this GPIO from the capture')
+  parser.add_argument('--control-socket', dest='control_socket', default=client.DEFAULT_CONTROL_SOCKET,
+                      help='The Unix socket on which a listening daemon accepts commands')
+  parser.add_argument('--control-mode', dest='control_mode', type=lambda mode: int(mode, 8), default=0o660,
+                      help='The permissions of the control socket in listen mode, in octal')
+  parser.add_argument('--control-group', dest='control_group',
+                      help='The group owning the control socket in listen mode, whose members may send commands')
+  parser.add_argument('--direct', dest='direct', action='store_true',
+                      help='Transmit pair/on/off directly, even if a listening daemon is running')
+  parser.add_argument('--metrics-port', dest='metrics_port', type=int,
+                      help='Serve Prometheus metrics on this localhost HTTP port in listen mode')
+  parser.add_argument('--max-burst', dest='max_burst', type=float, default=2.0,
+                      help='Longest time in seconds on air for one burst of interleaved commands in listen mode')
+  parser.add_argument('--max-backlog', dest='max_backlog', type=float, default=30.0,
+                      help='Most seconds of airtime queued per pigpio daemon in listen mode, beyond which commands are refused')
+  parser.add_argument('--backlog-policy', dest='backlog_policy', choices=['reject', 'drop-oldest'], default='reject',
+                      help='Whether a full backlog refuses new commands with ERR busy or drops the oldest pending ones')
+  parser.add_argument('--duty-cycle', dest='duty_cycle', type=float,
+                      help='Largest fraction of time each transmitter may be on air, e.g. 0.1 for 10%%')
+  parser.add_argument('--duty-window', dest='duty_window', type=float, default=60.0,
+                      help='Seconds over which the duty cycle is measured')
+  parser.add_argument('--tx-process', dest='tx_process', action='store_true',
+                      help='Run the local transmitters in a separate process in listen mode')
+  parser.add_argument('--tx-cpu', dest='tx_cpu', type=int,
+                      help='Pin the transmit process to this CPU')
+  parser.add_argument('--tx-priority', dest='tx_priority', type=int, default=50,
+                      help='SCHED_FIFO priority of the transmit process, 1-99 (needs root)')
+  parser.add_argument('--notify-on-transmit', dest='completion_events', action='store_true',
+                      help='Send the JSON event for a command once it has been transmitted rather than when it is queued')
+  parser.add_argument('--rx-port', dest='rx_port', type=int, default=9760,
+                      help='UDP port on which to receive commands in listen mode')
+  parser.add_argument('--peers', dest='peers', action='store_true',
+                      help='Coordinate with other hubs on the network so each message is handled by only one')
+  parser.add_argument('--peer-id', dest='peer_id',
+                      help='This hub\'s id among its peers, by default <hostname>:<pid>')
+  parser.add_argument('--peer-group', dest='peer_group', default='239.255.97.60',
+                      help='Multicast group on which the peers exchange heartbeats')
+  parser.add_argument('--peer-port', dest='peer_port', type=int, default=9762,
+                      help='UDP port on which the peers exchange heartbeats')
+  parser.add_argument('--trace-size', dest='trace_size', type=int, default=100,
+                      help='Commands kept in the trace of the listen daemon, 0 for none')
+  parser.add_argument('--profile-dir', dest='profile_dir',
+                      help='Directory for the profiles and traces written by the listen daemon, by default $STATE_DIRECTORY or /var/lib/piwaverf')
+  parser.add_argument('--state-file', dest='state_file',
+                      help='Keep the devices\' last known states in this sqlite file in listen mode')
+  parser.add_argument('--redundant', dest='redundant', choices=['send', 'skip', 'shorten'], default='send',
+                      help='What to do with a command matching the device\'s last known state in listen mode')
+  parser.add_argument('--redundant-ttl', dest='redundant_ttl', type=float, default=300.0,
+                      help='Seconds for which a device\'s last known state is trusted')
+  parser.add_argument('--state-from-received', dest='state_from_received', action='store_true',
+                      help='Update the known states from commands heard on the receiver')
+  parser.add_argument('--trials', dest='trials', type=int, default=10,
+                      help='Commands to send for each repeat count and gap when calibrating')
+  parser.add_argument('--margin', dest='margin', type=int, default=1,
+                      help='Repeats to add to the calibrated minimum in the recommendation')
+  parser.add_argument('-o', '--output', dest='output_file',
+                      help='Write the calibrated profile to this file as a mappings fragment')
+  parser.add_argument('--noise', dest='noise', type=float, default=0.0,
+                      help='Chance of a glitch after each edge received by the simulation')
+  parser.add_argument('--jitter', dest='jitter', type=float, default=0.0,
+                      help='Standard deviation in microseconds of edges received by the simulation')
 
   args = parser.parse_args()
 
-  if args.command in ['pair', 'on', 'off'] and (args.room_name is None or args.device_name is None):
-    print('Room & device are required for command pair, on, and off')
+  if args.command in ['pair', 'on', 'off', 'calibrate'] and (args.room_name is None or args.device_name is None):
+    print('Room & device are required for command pair, on, off, and calibrate')
     sys.exit(2)
 
-  controller = piwaverf.Controller(args.transmitter)
-  if args.command in ['pair', 'on', 'off']:
-    mappings = piwaverf.DeviceMappings(args.mapping_file)
+  if args.command == 'calibrate' and args.rx_gpio is None:
+    print('A receiver GPIO is required for command calibrate')
+    sys.exit(2)
+
+  if args.command == 'decode':
+    if args.capture_file is None:
+      print('A capture file is required for command decode')
+      sys.exit(2)
+    decode_capture(args.capture_file, args.capture_gpio)
+    return
+
+  if args.command in ['stats', 'profile', 'trace']:
+    try:
+      reply = client.query(f'@{args.command}', args.control_socket)
+    except PermissionError:
+      print(f'Not permitted to use {args.control_socket}, see --control-group')
+      sys.exit(1)
+    if reply is None:
+      print(f'No daemon is listening on {args.control_socket}')
+      sys.exit(1)
+    print(reply if reply.endswith('\n') else reply + '\n', end='')
+    return
+
+  if args.command == 'status':
+    status(args)
+    return
+
+  mappings = None
+  if args.command in ['pair', 'on', 'off', 'calibrate']:
+    from mappings import DeviceMappings
+    mappings = DeviceMappings(args.mapping_file, check_interval=None)
 
     device = mappings.device_id(args.room_name, args.device_name)
     if device is None:
@@ -42,6 +145,40 @@ def main(argv):
 
     print(f'Sending "{args.command}" to device "{args.device_name}" ({device.device_id}) in room "{args.room_name}" ({device.room_id})')
 
+    # the daemon transmits with its own transmitter ID and mappings
+    own = args.transmitter == DEFAULT_TRANSMITTER_ID and args.mapping_file == DEFAULT_MAPPING_FILE
+    if args.command != 'calibrate' and not args.direct and not args.simulate and own and submit_to_daemon(args.command, device, args.control_socket):
+      return
+
+  elif args.command == 'listen' and Path(args.mapping_file).exists():
+    from mappings import DeviceMappings
+    mappings = DeviceMappings(args.mapping_file)
+
+  # driving the transmitter directly
+  import piwaverf
+
+  pi = None
+  connect = None
+  if args.simulate:
+    import sim
+    print('Using simulated pigpio')
+    pi = sim.SimulatedPi(jitter=args.jitter, noise=args.noise)
+    if args.rx_gpio is not None:
+      pi.link(piwaverf.Controller._DEFAULT_TX_GPIO_PIN, args.rx_gpio)
+    connect = lambda host, port: sim.SimulatedPi() # for remote transmitters
+
+  tx_process = None
+  if args.tx_process and args.command == 'listen':
+    import txprocess
+    # the process makes its own connection, so a simulated one cannot be shared with receivers
+    tx_process = txprocess.TransmitProcessConfig(args.tx_cpu, args.tx_priority, sim.SimulatedPi if args.simulate else None)
+
+  transmitters = mappings.transmitters() if mappings is not None else None
+  metrics = piwaverf.Metrics()
+  controller = piwaverf.Controller(args.transmitter, pi=pi, metrics=metrics, mappings=mappings,
+                                   max_burst=args.max_burst, transmitters=transmitters, connect=connect,
+                                   duty_cycle=args.duty_cycle, duty_window=args.duty_window, tx_process=tx_process)
+  if args.command in ['pair', 'on', 'off']:
     if args.command == 'pair':
       controller.send(device.room_id, device.device_id, piwaverf.LightCommand.Off)
     elif args.command == 'on':
@@ -49,20 +186,150 @@ def main(argv):
     elif args.command == 'off':
       controller.send(device.room_id, device.device_id, piwaverf.LightCommand.Off)
 
+  elif args.command == 'calibrate':
+    calibrate(controller, device, mappings.device_name(device.room_id, device.device_id), args)
+
   elif args.command == 'listen':
     print('Starting in listen mode')
 
-    hub = piwaverf.Hub(controller)
+    receiver = None
+    if args.rx_gpio is not None:
+      print(f'Receiving on GPIO{args.rx_gpio}')
+      receiver = controller.receiver(args.rx_gpio, dedup_ttl=int(args.rx_dedup * 1000))
+
+    peer_group = None
+    if args.peers:
+      import peers
+      peer_group = peers.PeerGroup(args.peer_id, args.peer_group, args.peer_port)
+
+    import profiling
+    profile_dir = args.profile_dir or profiling.DEFAULT_DIRECTORY
+    profiler = profiling.Profiler(profile_dir)
+    trace = profiling.Trace(args.trace_size, profile_dir) if args.trace_size > 0 else None
+
+    state = piwaverf.StateStore(args.state_file, args.redundant, args.redundant_ttl, use_received=args.state_from_received)
+    hub_class = piwaverf.AsyncHub if args.use_asyncio else piwaverf.Hub
+    hub = hub_class(controller, receiver=receiver, mappings=mappings, control_path=args.control_socket, metrics=metrics,
+                    state=state, max_backlog=args.max_backlog, backlog_policy=args.backlog_policy,
+                    completion_events=args.completion_events, peers=peer_group, rx_port=args.rx_port,
+                    trace=trace, profiler=profiler, control_mode=args.control_mode, control_group=args.control_group)
+    if args.metrics_port is not None:
+      metrics.serve(args.metrics_port)
 
     def hub_shutdown(sig, frame):
       print('Shutting down...')
       hub.shutdown()
     signal.signal(signal.SIGINT, hub_shutdown)
 
+    # handled on a thread of their own, as the hub may be using the profiler or trace
+    # on the thread the signal interrupts
+    signal.signal(signal.SIGUSR1, lambda sig, frame: threading.Thread(target=profiler.toggle).start())
+    if trace is not None:
+      signal.signal(signal.SIGUSR2, lambda sig, frame: threading.Thread(target=trace.dump).start())
+    else:
+      signal.signal(signal.SIGUSR2, lambda sig, frame: threading.Thread(target=print, args=('Tracing disabled',)).start())
+
     hub.start()
+    state.close()
 
   controller.shutdown()
 
 
+def status(args):
+  """Prints the last known states of all devices, or of a room or device, from the listen daemon."""
+  import json
+
+  target = ''
+  if args.room_name is not None:
+    from mappings import DeviceMappings
+    mappings = DeviceMappings(args.mapping_file, check_interval=None)
+    if args.device_name is not None:
+      device = mappings.device_id(args.room_name, args.device_name)
+      if device is None:
+        print(f'Could not locate device "{args.device_name}" in room "{args.room_name}" in mappings file "{args.mapping_file}", exiting.')
+        sys.exit(1)
+      target = f' R{device.room_id}D{device.device_id}'
+    else:
+      room_id = mappings.room_id(args.room_name)
+      if room_id is None:
+        print(f'Could not locate room "{args.room_name}" in mappings file "{args.mapping_file}", exiting.')
+        sys.exit(1)
+      target = f' R{room_id}'
+
+  try:
+    reply = client.query(f'@state{target}', args.control_socket)
+  except socket.timeout:
+    print(f'No reply from the daemon on {args.control_socket}, exiting.')
+    sys.exit(1)
+  except PermissionError:
+    print(f'Not permitted to use {args.control_socket}, see --control-group')
+    sys.exit(1)
+  if reply is None:
+    print(f'No daemon is listening on {args.control_socket}')
+    sys.exit(1)
+  print(json.dumps(json.loads(reply), indent=2))
+
+
+def submit_to_daemon(command, device, control_socket):
+  """Sends a command through a running listen daemon. Returns False if there is none,
+     in which case the caller should transmit it directly."""
+  function = 'F1' if command == 'on' else 'F0' # pairing is done with an off command
+  try:
+    reply = client.submit(f'!R{device.room_id}D{device.device_id}{function}', control_socket)
+  except socket.timeout:
+    print(f'No reply from the daemon on {control_socket}, exiting.')
+    sys.exit(1)
+  except PermissionError:
+    print(f'Not permitted to use {control_socket}, see --control-group')
+    sys.exit(1)
+  if reply is None:
+    return False
+
+  fields = reply.split(',', 2)
+  if len(fields) < 2 or fields[1] != 'OK':
+    print(f'Daemon rejected the command: {reply}')
+    sys.exit(1)
+  print(f'Queued by the daemon on {control_socket}')
+  return True
+
+
+def calibrate(controller, device, names, args):
+  """Finds the cheapest reliable repeat count and gap for a device, as heard by a receiver
+     near the transmitter, and recommends them with a margin for the device being further away."""
+  import piwaverf
+  import yaml
+
+  print(f'Calibrating against GPIO{args.rx_gpio} with {args.trials} trials per setting; the device will be switched on repeatedly')
+  receiver = controller.receiver(args.rx_gpio, dedup_ttl=0)
+  results = controller.calibrate(receiver, device.room_id, device.device_id, trials=args.trials)
+  if not results:
+    print('No setting was decoded reliably, keep the defaults')
+    sys.exit(1)
+
+  best = results[0]
+  repeat = min(best.repeat + args.margin, piwaverf.Controller._DEFAULT_TX_REPEAT)
+  print(f'Fewest repeats decoded reliably: {best.repeat} with a {best.gap}us gap, {best.airtime:.3f}s on air')
+  fragment = {'room': [{'name': names[0], 'device': [{'name': names[1], 'repeat': repeat, 'gap': best.gap}]}]}
+  text = yaml.safe_dump(fragment, sort_keys=False)
+  print(f'Recommended mappings entry:\n{text}', end='')
+  if args.output_file is not None:
+    with open(args.output_file, 'w') as fh:
+      fh.write(f'# calibrated with {args.trials} trials per setting and a margin of {args.margin}\n')
+      fh.write(text)
+    print(f'Written to {args.output_file}')
+
+
+def decode_capture(capture_file, gpio):
+  import capture
+  import piwaverf
+
+  ticks, levels = capture.read_edges(capture_file, gpio)
+  start = time.time()
+  messages = capture.decode_edges(ticks, levels)
+  print(f'Decoded {len(messages)} messages from {len(ticks)} edges in {time.time() - start:.2f}s')
+  for tick, message in messages:
+    print(f'{tick} {"".join(f"{nibble:X}" for nibble in message)} {piwaverf.Controller.decode(message)}')
+
+
 if __name__ == "__main__":
   main(sys.argv)
@@ -0,0 +1,214 @@
+"""Names for rooms and devices, read from a LightwaveRF Gem compatible file.
+   Kept apart from the hub so it can be used without pigpio."""
+
+import os
+import time
+from dataclasses import dataclass
+
+import yaml
+
+
+@dataclass
+class Device:
+  room_id: int
+  device_id: int
+
+
+@dataclass
+class TransmitProfile:
+  repeat: int = None # frames per command
+  gap: int = None # microseconds of silence before each frame
+
+
+@dataclass
+class TransmitterConfig:
+  name: str
+  gpio: int = None # the controller's default GPIO if None
+  host: str = None # the local pigpiod if None
+  port: int = None # pigpio's default port if None
+
+
+class DeviceMappings:
+  """Read device mappings from a LightwaveRF Gem (https://github.com/pauly/lightwaverf) 
+     compatible file.
+
+     The file is compiled into dictionaries indexed by name and by ID. It is checked
+     for changes at most every check_interval seconds, and reloaded if its mtime has
+     changed; the new indexes replace the old in one assignment, so lookups never
+     take a lock or see a partly loaded file. A check_interval of None disables
+     reloading.
+
+     Rooms and devices may have repeat and gap entries, overriding the transmitter's
+     defaults; a device inherits any its room has.
+
+     A transmitter list names GPIOs on the local or remote pigpio daemons, and a room
+     may name the transmitter which serves it; other rooms use the first."""
+
+  MAX_REPEAT = 255
+  MIN_GAP = 5001 # receivers need more than lwrf.RX_PULSE_MAX to find a frame start
+  MAX_GAP = 100000
+
+
+  def __init__(self, filename, check_interval=1.0):
+    self._filename = filename
+    self._check_interval = check_interval
+    self._next_check = 0
+    self._mtime = os.stat(filename).st_mtime_ns
+    self._index = self._compile(self._load())
+    if check_interval is not None:
+      self._next_check = time.monotonic() + check_interval
+
+
+  def device_id(self, room_name, device_name):
+    """Returns the Device for a room & device name, ignoring case, or None."""
+    return self._current()[0].get((room_name.casefold(), device_name.casefold()))
+
+
+  def device_name(self, room_id, device_id):
+    """Returns the (room name, device name) for a room & device ID, or None."""
+    return self._current()[1].get((room_id, device_id))
+
+
+  def room_id(self, room_name):
+    """Returns the ID of a room, ignoring case, or None."""
+    return self._current()[2].get(room_name.casefold())
+
+
+  def room_name(self, room_id):
+    """Returns the name of the room with an ID, or None."""
+    return self._current()[3].get(room_id)
+
+
+  def transmit_profile(self, room_id, device_id):
+    """Returns the TransmitProfile for a device, or for a room if device_id is None,
+       or None if the file has no overrides for it."""
+    return self._current()[4].get((room_id, device_id))
+
+
+  def transmitters(self):
+    """Returns the TransmitterConfigs in the file, which may be none."""
+    return list(self._current()[5])
+
+
+  def transmitter(self, room_id):
+    """Returns the name of the transmitter serving a room, or None for the first."""
+    return self._current()[6].get(room_id)
+
+
+  def reload(self):
+    """Reloads the file, keeping the current mappings if it cannot be read."""
+    try:
+      mtime = os.stat(self._filename).st_mtime_ns
+      index = self._compile(self._load())
+    except (OSError, yaml.YAMLError, KeyError, TypeError, ValueError) as e:
+      print(f'Failed to reload mappings from {self._filename}, keeping the current mappings: {e}')
+      return False
+    self._mtime = mtime
+    self._index = index
+    print(f'Reloaded mappings from {self._filename}')
+    return True
+
+
+  def _current(self):
+    if self._check_interval is not None and time.monotonic() >= self._next_check:
+      self._next_check = time.monotonic() + self._check_interval
+      try:
+        mtime = os.stat(self._filename).st_mtime_ns
+      except OSError:
+        mtime = self._mtime
+      if mtime != self._mtime:
+        self._mtime = mtime # a broken file is only reported once
+        self.reload()
+    return self._index
+
+
+  def _load(self):
+    with open(self._filename, 'r') as fh:
+      return yaml.safe_load(fh)
+
+
+  @classmethod
+  def _compile(cls, config):
+    """Returns the (device by names, names by device, room by name, name by room,
+       profile by device, transmitters, transmitter by room) indexes. Where names or
+       IDs are repeated, the first in the file wins."""
+    devices = {}
+    names = {}
+    rooms = {}
+    room_names = {}
+    profiles = {}
+    if not isinstance(config, dict) or not isinstance(config.get('room'), list):
+      raise ValueError('mappings must have a room list')
+    transmitters = tuple(cls._transmitter(entry) for entry in config.get('transmitter') or [])
+    transmitter_names = set(transmitter.name for transmitter in transmitters)
+    if len(transmitter_names) != len(transmitters):
+      raise ValueError('transmitter names must be unique')
+    room_transmitters = {}
+    for room_index, room in enumerate(config['room'], 1):
+      room_name = cls._name(room, 'rooms')
+      room_id = cls._id_int(room.get('id')) or room_index
+      rooms.setdefault(room_name.casefold(), room_id)
+      room_names.setdefault(room_id, room_name)
+      room_profile = cls._profile(room, TransmitProfile())
+      if room_profile != TransmitProfile():
+        profiles.setdefault((room_id, None), room_profile)
+      transmitter = room.get('transmitter')
+      if transmitter is not None:
+        if transmitter not in transmitter_names:
+          raise ValueError(f'transmitter for {room_name} is not in the transmitter list, found: {transmitter}')
+        room_transmitters.setdefault(room_id, transmitter)
+
+      for device_index, device in enumerate(room.get('device') or [], 1):
+        device_name = cls._name(device, f'devices in {room_name}')
+        device_id = cls._id_int(device.get('id')) or device_index
+        devices.setdefault((room_name.casefold(), device_name.casefold()), Device(room_id, device_id))
+        names.setdefault((room_id, device_id), (room_name, device_name))
+        profile = cls._profile(device, room_profile)
+        if profile != TransmitProfile():
+          profiles.setdefault((room_id, device_id), profile)
+
+    return devices, names, rooms, room_names, profiles, transmitters, room_transmitters
+
+
+  @staticmethod
+  def _name(entry, kind):
+    name = entry.get('name') if isinstance(entry, dict) else None
+    if not isinstance(name, str):
+      raise ValueError(f'{kind} must have a name, found: {entry}')
+    return name
+
+
+  @classmethod
+  def _profile(cls, entry, inherited):
+    repeat = entry.get('repeat', inherited.repeat)
+    gap = entry.get('gap', inherited.gap)
+    if repeat is not None and (not isinstance(repeat, int) or not 1 <= repeat <= cls.MAX_REPEAT):
+      raise ValueError(f'repeat for {entry.get("name")} must be between 1 and {cls.MAX_REPEAT}, found: {repeat}')
+    if gap is not None and (not isinstance(gap, int) or not cls.MIN_GAP <= gap <= cls.MAX_GAP):
+      raise ValueError(f'gap for {entry.get("name")} must be between {cls.MIN_GAP} and {cls.MAX_GAP} microseconds, found: {gap}')
+    return TransmitProfile(repeat, gap)
+
+
+  @staticmethod
+  def _transmitter(entry):
+    name = entry.get('name')
+    gpio = entry.get('gpio')
+    port = entry.get('port')
+    if not isinstance(name, str):
+      raise ValueError(f'transmitters must have a name, found: {name}')
+    if gpio is not None and (not isinstance(gpio, int) or not 0 <= gpio <= 31):
+      raise ValueError(f'gpio for transmitter {name} must be between 0 and 31, found: {gpio}')
+    if port is not None and (not isinstance(port, int) or not 0 < port < 65536):
+      raise ValueError(f'port for transmitter {name} must be between 1 and 65535, found: {port}')
+    return TransmitterConfig(name, gpio, entry.get('host'), port)
+
+
+  @staticmethod
+  def _id_int(value):
+    """The numeric part of an ID such as D12, or None."""
+    if value is None:
+      return None
+    if isinstance(value, int):
+      return value
+    digits = ''.join(c for c in str(value) if c.isdigit())
+    return int(digits) if digits else None
@@ -0,0 +1,142 @@
+"""Counters and fixed-bucket histograms for the hub, rendered in the Prometheus text
+   format. Updates take no lock: each metric is normally updated from one thread,
+   and a rare lost update under contention is an acceptable price for that."""
+
+import bisect
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# seconds, from parsing a datagram to a long burst of repeats
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+REPEATS_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+
+
+class Histogram:
+
+  def __init__(self, buckets, help_text=''):
+    self.buckets = tuple(buckets)
+    self.help = help_text
+    self.counts = [0] * (len(self.buckets) + 1) # the last is +Inf
+    self.sum = 0.0
+    self.count = 0
+
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+
+class Metrics:
+  """The hub's metrics. Histograms and counters are created on first use, so
+     instrumented code only needs to name them."""
+
+  PREFIX = 'piwaverf_'
+
+  _HELP = {
+    'commands': 'Commands accepted for transmission',
+    'errors': 'Messages answered with an error',
+    'coalesced': 'Pending commands replaced by a newer command for the same device',
+    'dropped': 'Accepted commands which were never transmitted',
+    'busy': 'Commands refused as the transmit backlog was full',
+    'deferred': 'Messages left for another hub among the peers to answer',
+    'skipped': 'Commands not transmitted as the device was already in the requested state',
+    'shortened': 'Commands transmitted with fewer repeats as the device was already in the requested state',
+    'received_duplicates': 'Repeats of received messages which were not reported again',
+    'received_edges': 'Edges seen by the receiver, each costing a callback',
+    'received_discarded': 'Received edges discarded as glitches or outside a message',
+    'tx_cache_hits': 'Messages whose waveform was already in the transmitter\'s cache',
+    'tx_cache_misses': 'Messages whose waveform had to be created',
+    'tx_cache_evictions': 'Cached waveforms deleted to make room for new ones',
+    'handle_seconds': 'Time from receiving a datagram to sending its response',
+    'queue_wait_seconds': 'Time commands waited in the transmit queue',
+    'send_seconds': 'Time taken to transmit a command, including airtime',
+    'completion_seconds': 'Time from accepting a command to the end of its transmission, for completion events',
+    'waveform_build_seconds': 'Time spent looking up or creating waveforms per transmission',
+    'airtime_seconds': 'Time on air per transmission',
+    'duty_wait_seconds': 'Time transmissions were held back by the duty cycle limit',
+    'repeats': 'Frames transmitted per command',
+  }
+
+
+  def __init__(self):
+    self.counters = {}
+    self.histograms = {}
+    self.collectors = {}
+
+
+  def count(self, name, increment=1):
+    self.counters[name] = self.counters.get(name, 0) + increment
+
+
+  def collect(self, name, func, label=None):
+    """Reports func(), a running total kept elsewhere, as a counter. If label is given,
+       func returns a dict of totals by the values of that label instead."""
+    self.collectors[name] = (func, label)
+
+
+  def observe(self, name, value):
+    histogram = self.histograms.get(name)
+    if histogram is None:
+      buckets = SECONDS_BUCKETS if name.endswith('_seconds') else REPEATS_BUCKETS
+      histogram = self.histograms.setdefault(name, Histogram(buckets, self._HELP.get(name, '')))
+    histogram.observe(value)
+
+
+  def prometheus(self):
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    counters = {name: (value, None) for name, value in self.counters.items()}
+    counters.update((name, (func(), label)) for name, (func, label) in self.collectors.items())
+    for name in sorted(counters):
+      metric = f'{self.PREFIX}{name}_total'
+      value, label = counters[name]
+      lines.append(f'# HELP {metric} {self._HELP.get(name, name)}')
+      lines.append(f'# TYPE {metric} counter')
+      if label is None:
+        lines.append(f'{metric} {value}')
+      else:
+        lines.extend(f'{metric}{{{label}={json.dumps(key, ensure_ascii=False)}}} {total}' for key, total in value.items())
+
+    for name in sorted(self.histograms):
+      histogram = self.histograms[name]
+      metric = f'{self.PREFIX}{name}'
+      lines.append(f'# HELP {metric} {histogram.help or name}')
+      lines.append(f'# TYPE {metric} histogram')
+      counts = list(histogram.counts) # a consistent copy, as observations may continue
+      cumulative = 0
+      for bound, count in zip(histogram.buckets, counts):
+        cumulative += count
+        lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+      cumulative += counts[-1]
+      lines.append(f'{metric}_bucket{{le="+Inf"}} {cumulative}')
+      lines.append(f'{metric}_sum {histogram.sum}')
+      lines.append(f'{metric}_count {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+  def serve(self, port, address='127.0.0.1'):
+    """Serves the metrics over HTTP from a daemon thread, returning the server."""
+    metrics = self
+
+    class Handler(BaseHTTPRequestHandler):
+
+      def do_GET(self):
+        body = metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+      def log_message(self, format, *args):
+        pass
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    threading.Thread(target=server.serve_forever, name='piwaverf-metrics', daemon=True).start()
+    print(f'Serving metrics on http://{address}:{server.server_address[1]}/metrics')
+    return server
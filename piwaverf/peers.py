@@ -0,0 +1,141 @@
+"""Coordinates several hubs on one network, so a command broadcast to all of them is
+   acknowledged and transmitted by exactly one. Each hub multicasts a heartbeat, and
+   every room is owned by one of the hubs heard recently, chosen by rendezvous
+   hashing of the hub ids: all hubs agree on the owner without an election, and when
+   a hub goes silent only its rooms move, to the surviving hubs."""
+
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+
+DEFAULT_GROUP = '239.255.97.60'
+DEFAULT_PORT = 9762
+DEFAULT_INTERVAL = 0.5 # seconds between heartbeats
+DEFAULT_TIMEOUT = 1.5 # seconds without a heartbeat before a peer is presumed gone
+
+_MAGIC = b'PIWAVERF-PEER/1'
+_HELLO = b'HELLO'
+_BYE = b'BYE'
+
+
+def default_id():
+  return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class PeerGroup:
+  """This hub's membership of the group of hubs multicasting on group:port. Heartbeats
+     are sent and received on a daemon thread once started."""
+
+
+  def __init__(self, peer_id=None, group=DEFAULT_GROUP, port=DEFAULT_PORT, interval=DEFAULT_INTERVAL,
+               timeout=DEFAULT_TIMEOUT, interface='0.0.0.0'):
+    self.id = peer_id if peer_id is not None else default_id()
+    self.group = group
+    self.port = port
+    self.interval = interval
+    self.timeout = timeout
+    self.interface = interface
+    self._peers = {} # id -> time.monotonic() of its last heartbeat, excluding this hub
+    self._socket = None
+    self._thread = None
+    self._running = False
+
+
+  def start(self):
+    """Joins the group, returning once the peers have had time to answer."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # several hubs may share a host
+    s.bind(('', self.port))
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                 struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton(self.interface)))
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    if self.interface != '0.0.0.0':
+      s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+    self._socket = s
+    self._running = True
+    self._thread = threading.Thread(target=self._run, name='piwaverf-peers', daemon=True)
+    self._thread.start()
+    print(f'Coordinating with peers on {self.group}:{self.port} as {self.id}')
+    time.sleep(self.interval) # for the peers to answer, before claiming any rooms
+
+
+  def stop(self):
+    """Leaves the group, so the peers take over this hub's rooms at once."""
+    if self._socket is None:
+      return
+    self._running = False
+    self._send(_BYE)
+    self._thread.join()
+    self._socket.close()
+    self._socket = None
+
+
+  def peers(self):
+    """Returns the ids of the hubs heard within the timeout, including this one."""
+    now = time.monotonic()
+    return sorted([peer for peer, heard in list(self._peers.items()) if now - heard <= self.timeout] + [self.id])
+
+
+  def owner(self, room_number):
+    """Returns the id of the hub which handles room_number."""
+    return max(self.peers(), key=lambda peer: (zlib.crc32(f'{peer}/{room_number}'.encode('utf-8')), peer))
+
+
+  def owns(self, room_number):
+    """Returns True if this hub handles room_number; room 0 stands for anything not
+       specific to a room, such as errors."""
+    return self.owner(room_number) == self.id
+
+
+  def _run(self):
+    self._socket.settimeout(self.interval)
+    next_heartbeat = 0.0
+    while self._running:
+      now = time.monotonic()
+      if now >= next_heartbeat:
+        self._send(_HELLO)
+        next_heartbeat = now + self.interval
+        self._expire(now)
+      try:
+        data, address = self._socket.recvfrom(256)
+      except socket.timeout:
+        continue
+      except OSError:
+        return
+      self._received(data)
+
+
+  def _received(self, data):
+    parts = data.split(b' ', 2)
+    if len(parts) != 3 or parts[0] != _MAGIC:
+      return
+    peer = parts[2].decode('utf-8', 'replace')
+    if peer == self.id:
+      return
+    if parts[1] == _BYE:
+      if self._peers.pop(peer, None) is not None:
+        print(f'Peer {peer} left')
+    elif parts[1] == _HELLO:
+      if peer not in self._peers:
+        print(f'Peer {peer} joined')
+        self._send(_HELLO) # so a hub which has just started learns of us at once
+      self._peers[peer] = time.monotonic()
+
+
+  def _expire(self, now):
+    for peer, heard in list(self._peers.items()):
+      if now - heard > self.timeout:
+        del self._peers[peer]
+        print(f'Peer {peer} went silent')
+
+
+  def _send(self, kind):
+    try:
+      self._socket.sendto(b' '.join((_MAGIC, kind, self.id.encode('utf-8'))), (self.group, self.port))
+    except OSError as e:
+      print(f'Failed to send peer heartbeat: {e}')
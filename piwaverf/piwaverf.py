@@ -1,24 +1,33 @@
+import asyncio
+import errno
+import grp
+import itertools
+import json
+import os
+import re
 import pigpio
 import time
-import yaml
 import socket
+import sqlite3
+import stat
+import struct
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
+from collections import OrderedDict, deque
+from dataclasses import dataclass, replace
 
 import lwrf
+import txprocess
+from mappings import Device, DeviceMappings, TransmitProfile, TransmitterConfig
+from metrics import Metrics
 
 
 class LightCommand:
   Off = 0
   On = 1
   Dim = 2
-
-
-@dataclass
-class Device:
-  room_id: int
-  device_id: int
+  AllOff = 3
+  Mood = 4
 
 
 class ResponseStatus:
@@ -36,47 +45,365 @@ class Response:
   argument: int = 0
   error_code: int = 0
   error_message: str = ''
+  batch: list = None
 
 
 @dataclass
-class ParsedCommand:
-  identitifer: int
+class ReceivedCommand:
+  transmitter_id: str
+  room_number: int
+  device_number: int # None for room-level commands
+  command: int
   argument: int = 0
 
 
-class DeviceMappings:
-  """Read device mappings from a LightwaveRF Gem (https://github.com/pauly/lightwaverf) 
-     compatible file."""
+@dataclass
+class Calibration:
+  repeat: int
+  gap: int # microseconds
+  decoded: float # fraction of trials in which a frame was decoded
+  airtime: float # seconds per command
 
 
-  def __init__(self, filename):
-    with open(filename, 'r') as fh:
-      self._config = yaml.safe_load(fh)
+@dataclass
+class QueuedCommand:
+  room_number: int
+  device_number: int # None for room-level commands
+  command: int
+  argument: int = 0
+  sequence: int = 0 # numbers the commands awaiting completion events, in the order queued
 
-  
-  def device_id(self, room_name, device_name):
-    room_index = 1
-    for room in self._config['room']:
-      if room.get('name').lower() == room_name.lower():
-        room_id = room.get('id') or room_index
-        device_index = 1
+  @property
+  def key(self):
+    return (self.room_number, self.device_number)
 
-        for device in room['device']:
-          if device.get('name').lower() == device_name.lower():
-            return Device(room_id, self._device_int(device.get('id')) or device_index)
 
-          device_index += 1
+@dataclass
+class QueuedBatch:
+  commands: list
 
-      room_index += 1
-    
-    return None
+  @property
+  def key(self):
+    return tuple(command.key for command in self.commands)
 
 
-  def _device_int(self, string_value):
-    if string_value is not None:
-      return [int(s) for s in string_value if s.isdigit()][0]
-    else:
-      return None
+@dataclass
+class DeviceState:
+  command: int
+  argument: int
+  updated: float # time.time() of the command
+  source: str # StateStore.SENT or StateStore.RECEIVED
+
+
+class StateStore:
+  """The last known state of each device, from the commands the hub sends and, if
+     use_received is set, those received from other transmitters. Held in memory and,
+     if a path is given, written through to a small sqlite database so it survives
+     restarts. Thread safe.
+
+     A command is redundant if it matches what was last sent or received for its target
+     within ttl seconds. policy decides whether redundant commands are sent anyway
+     (SEND), skipped (SKIP) or sent with only shortened_repeat frames (SHORTEN)."""
+
+  SEND = 'send'
+  SKIP = 'skip'
+  SHORTEN = 'shorten'
+  POLICIES = (SEND, SKIP, SHORTEN)
+
+  # as the pkt field of the JSON events
+  SENT = '433T'
+  RECEIVED = '433R'
+
+  _DEFAULT_TTL = 300.0
+  _DEFAULT_SHORTENED_REPEAT = 3
+
+
+  def __init__(self, path=None, policy=SEND, ttl=_DEFAULT_TTL, shortened_repeat=_DEFAULT_SHORTENED_REPEAT, use_received=False):
+    if policy not in self.POLICIES:
+      raise ValueError(f'Policy must be one of {", ".join(self.POLICIES)}, found: {policy}')
+    self.policy = policy
+    self.ttl = ttl
+    self.shortened_repeat = shortened_repeat
+    self.use_received = use_received
+    self._states = {} # (room, device or None) -> DeviceState
+    self._lock = threading.Lock()
+    self._db = None
+    if path is not None:
+      self._db = sqlite3.connect(path, check_same_thread=False)
+      with self._db:
+        self._db.execute('CREATE TABLE IF NOT EXISTS state (room INTEGER, device INTEGER, command INTEGER, argument INTEGER, '
+                         'updated REAL, source TEXT, PRIMARY KEY (room, device)) WITHOUT ROWID')
+      for room, device, command, argument, updated, source in self._db.execute('SELECT * FROM state'):
+        self._states[(room, device or None)] = DeviceState(command, argument, updated, source)
+      print(f'Loaded {len(self._states)} device states from {path}')
+
+
+  def get(self, room_number, device_number):
+    """Returns the DeviceState of a device, or of a room if device_number is None, or None."""
+    return self._states.get((room_number, device_number))
+
+
+  def states(self):
+    """Returns ((room, device), DeviceState) pairs for everything known, in room & device order."""
+    with self._lock:
+      items = list(self._states.items())
+    return sorted(items, key=lambda item: (item[0][0], item[0][1] or 0))
+
+
+  def redundant(self, room_number, device_number, command, argument):
+    state = self._states.get((room_number, device_number))
+    return (state is not None and state.command == command and state.argument == (argument or 0) and
+            time.time() - state.updated < self.ttl)
+
+
+  def record(self, room_number, device_number, command, argument, source=SENT):
+    """Records a command sent or received. All off turns off every known device in the
+       room; after a mood their levels are unknown."""
+    now = time.time()
+    changes = {(room_number, device_number): DeviceState(command, argument or 0, now, source)}
+    with self._lock:
+      if device_number is not None:
+        changes[(room_number, None)] = None # the room's last command no longer describes it
+      else:
+        for key in self._states:
+          if key[0] == room_number and key[1] is not None:
+            changes[key] = DeviceState(LightCommand.Off, 0, now, source) if command == LightCommand.AllOff else None
+      for key, state in changes.items():
+        if state is None:
+          self._states.pop(key, None)
+        else:
+          self._states[key] = state
+
+      if self._db is not None:
+        with self._db:
+          self._db.executemany('DELETE FROM state WHERE room = ? AND device = ?',
+                               [(room, device or 0) for (room, device), state in changes.items() if state is None])
+          self._db.executemany('INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?, ?, ?)',
+                               [(room, device or 0, state.command, state.argument, state.updated, state.source)
+                                for (room, device), state in changes.items() if state is not None])
+
+
+  def close(self):
+    if self._db is not None:
+      self._db.close()
+      self._db = None
+
+
+class BacklogFull(RuntimeError):
+  """A command was refused as the transmit backlog holds too much airtime already."""
+
+
+class TransmitError(RuntimeError):
+  """A burst was not transmitted, such as when pigpio could not create its waveforms."""
+
+
+class CommandBacklog:
+  """Pending transmissions, holding only the newest command for each key (the
+     room/device pair, or the set of them for a batch), and the estimated seconds
+     on air of them all. Not thread safe, callers must provide their own locking."""
+
+  REJECT = 'reject'
+  DROP_OLDEST = 'drop-oldest'
+  POLICIES = (REJECT, DROP_OLDEST)
+
+
+  def __init__(self):
+    self._pending = OrderedDict() # key -> (command, submitted, airtime)
+    self.coalesced = 0
+    self.airtime = 0.0
+
+
+  def put(self, command, airtime=0.0):
+    key = command.key
+    previous = self._pending.get(key)
+    if previous is not None:
+      self.coalesced += 1
+      self.airtime -= previous[2]
+    # an existing entry keeps its place in the queue
+    self._pending[key] = (command, time.monotonic(), airtime)
+    self.airtime += airtime
+    return previous is not None
+
+
+  def fits(self, command, airtime, limit):
+    """Returns True if putting command would keep the backlog within limit seconds of
+       airtime. A command with nothing else pending always fits."""
+    previous = self._pending.get(command.key)
+    others = self.airtime - (previous[2] if previous is not None else 0)
+    return len(self._pending) == (previous is not None) or others + airtime <= limit
+
+
+  def admit(self, command, airtime, limit=None, policy=REJECT):
+    """put(), first making room if the backlog would exceed limit seconds of airtime:
+       by dropping the oldest commands under the DROP_OLDEST policy, or else by raising
+       BacklogFull. Returns whether a command was superseded and the commands dropped."""
+    dropped = []
+    if limit is not None:
+      while not self.fits(command, airtime, limit):
+        if policy != self.DROP_OLDEST:
+          raise BacklogFull(f'{self.airtime:.1f}s of transmissions are already waiting')
+        dropped.append(self.pop()[0])
+    return self.put(command, airtime), dropped
+
+
+  def pop(self):
+    """Returns the oldest command and the time.monotonic() at which it was put."""
+    command, submitted, airtime = self._pending.popitem(last=False)[1]
+    self.airtime -= airtime
+    return command, submitted
+
+
+  def pop_burst(self, limit=None):
+    """Returns and removes the oldest pending (command, submitted) pairs whose airtime
+       together is within limit seconds, always at least one, or every pair if limit
+       is None. The rest stay pending, so they can still be superseded."""
+    pending = []
+    airtime = 0.0
+    while self._pending:
+      estimate = next(iter(self._pending.values()))[2]
+      if limit is not None and pending and airtime + estimate > limit:
+        break
+      pending.append(self.pop())
+      airtime += estimate
+    return pending
+
+
+  def __len__(self):
+    return len(self._pending)
+
+
+class TransmitQueue:
+  """Sends queued commands on a worker thread. Whatever is pending when the
+     transmitter becomes free is handed to send as one list, so the commands can
+     share a burst; if max_burst is given, only as many as estimate() says fit in
+     max_burst seconds on air. A command which has not yet started is replaced by any
+     newer command for the same device.
+
+     If max_backlog is given, estimate(command) returns each command's seconds on air
+     and commands which would take the backlog beyond max_backlog seconds are refused
+     or make room, as for CommandBacklog.admit() with policy. on_dropped, if given, is
+     called with a list of the commands dropped to make room."""
+
+
+  def __init__(self, send, metrics=None, name='piwaverf-tx', estimate=None, max_backlog=None, policy=CommandBacklog.REJECT,
+               on_dropped=None, max_burst=None):
+    self._send = send
+    self._metrics = metrics if metrics is not None else Metrics()
+    self._estimate = estimate
+    self._max_backlog = max_backlog
+    self._max_burst = max_burst
+    self._policy = policy
+    self._on_dropped = on_dropped
+    self._backlog = CommandBacklog()
+    self._condition = threading.Condition()
+    self._running = True
+    self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+    self._thread.start()
+
+
+  @property
+  def coalesced(self):
+    return self._backlog.coalesced
+
+
+  def fits(self, command):
+    """Returns True unless submit() would refuse command."""
+    if self._max_backlog is None or self._policy == CommandBacklog.DROP_OLDEST:
+      return True
+    airtime = self._estimate(command)
+    with self._condition:
+      return self._backlog.fits(command, airtime, self._max_backlog)
+
+
+  def submit(self, command):
+    airtime = self._estimate(command) if self._max_backlog is not None or self._max_burst is not None else 0.0
+    with self._condition:
+      if not self._running:
+        raise RuntimeError('Transmit queue has been shut down')
+      superseded, dropped = self._backlog.admit(command, airtime, self._max_backlog, self._policy)
+      self._condition.notify()
+    _count_admission(self._metrics, command, superseded, dropped, self.coalesced, self._on_dropped)
+
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while self._running and not self._backlog:
+          self._condition.wait()
+        if not self._backlog:
+          return
+        pending = self._backlog.pop_burst(self._max_burst)
+
+      now = time.monotonic()
+      for command, submitted in pending:
+        self._metrics.observe('queue_wait_seconds', now - submitted)
+      commands = [command for command, submitted in pending]
+      try:
+        self._send(commands)
+      except Exception as e:
+        self._metrics.count('dropped', len(commands))
+        print(f'Failed to send commands {commands}: {e}')
+
+
+  def shutdown(self, wait=True):
+    """Stops accepting commands; pending commands are still sent."""
+    with self._condition:
+      self._running = False
+      self._condition.notify()
+    if wait:
+      self._thread.join()
+
+
+def _count_admission(metrics, command, superseded, dropped, coalesced, on_dropped=None):
+  if superseded:
+    metrics.count('coalesced')
+    print(f'Superseded pending command for {command.key} ({coalesced} coalesced)')
+  for queued in dropped:
+    metrics.count('dropped', len(queued.commands) if isinstance(queued, QueuedBatch) else 1)
+    print(f'Dropped pending command for {queued.key} to make room in the backlog')
+  if dropped and on_dropped is not None:
+    on_dropped(dropped)
+
+
+class ShardedQueue:
+  """Routes commands to one transmit queue per shard, the pigpio daemon serving their
+     room, so each daemon transmits in parallel with the others. A batch spanning
+     shards is split between them, and refused as a whole unless every part fits.
+     shard(room) returns a command's shard."""
+
+
+  def __init__(self, queues, shard):
+    self.queues = queues
+    self._shard = shard
+
+
+  @property
+  def coalesced(self):
+    return sum(queue.coalesced for queue in self.queues.values())
+
+
+  def submit(self, command):
+    if not isinstance(command, QueuedBatch):
+      self.queues[self._shard(command.room_number)].submit(command)
+      return
+    parts = OrderedDict()
+    for queued in command.commands:
+      parts.setdefault(self._shard(queued.room_number), []).append(queued)
+    parts = [(self.queues[shard], QueuedBatch(commands) if len(commands) > 1 else commands[0])
+             for shard, commands in parts.items()]
+    if len(parts) > 1 and not all(queue.fits(part) for queue, part in parts):
+      raise BacklogFull('Too many transmissions are already waiting')
+    for queue, part in parts:
+      queue.submit(part)
+
+
+  def shutdown(self, wait=True):
+    """Stops all of the queues, as TransmitQueue.shutdown()."""
+    for queue in self.queues.values():
+      queue.shutdown(wait=False)
+    if wait:
+      for queue in self.queues.values():
+        queue.shutdown()
 
 
 class Hub:
@@ -85,152 +412,1231 @@ class Hub:
     _DEFAULT_RX_PORT = 9760
     _DEFAULT_TX_PORT = 9761
     _DUMMY_MAC_ADDRESS = 'a1:b2:c3:d4:e6:f6'
-
-
-    def __init__(self, controller, bind_address=_DEFAULT_BIND_ADDRESS, rx_port=_DEFAULT_RX_PORT, tx_port=_DEFAULT_TX_PORT, mac_address=_DUMMY_MAC_ADDRESS):
+    _DEFAULT_BROADCAST_ADDRESS = '255.255.255.255'
+    _MAX_DATAGRAM = 1024
+
+    # [:mac,]transaction,!command[!command...][|text...], with trailing whitespace
+    # such as netcat's newline allowed. A single command, by far the most common
+    # message, is matched in full; anything else is left in the last group.
+    _SEGMENT_PATTERN = rb'R(\d{1,3})(?:D(\d{1,3}))?F(0|1|a|dP(\d{1,3})|mP(\d{1,3}))'
+    _MESSAGE = re.compile(rb'(?::[^,]*,)?(\d*),!(?:(' + _SEGMENT_PATTERN + rb')|([^|]*?))\s*(?:\|.*)?', re.DOTALL)
+    _SEGMENT = re.compile(_SEGMENT_PATTERN)
+    _TRANSACTION = re.compile(rb'(?::[^,]*,)?(\d*)')
+    _PARSED_CACHE_SIZE = 256
+    _FUNCTIONS = {b'0': LightCommand.Off, b'1': LightCommand.On, b'a': LightCommand.AllOff}
+    _JSON_FUNCTIONS = {LightCommand.On: 'on', LightCommand.Off: 'off', LightCommand.Dim: 'dim',
+                       LightCommand.AllOff: 'allOff', LightCommand.Mood: 'mood'}
+    _TARGET = re.compile(rb'R(\d{1,3})(?:D(\d{1,3}))?')
+
+
+    def __init__(self, controller, bind_address=_DEFAULT_BIND_ADDRESS, rx_port=_DEFAULT_RX_PORT, tx_port=_DEFAULT_TX_PORT, mac_address=_DUMMY_MAC_ADDRESS,
+                 receiver=None, mappings=None, broadcast_address=_DEFAULT_BROADCAST_ADDRESS, control_path=None, metrics=None,
+                 state=None, max_backlog=None, backlog_policy=CommandBacklog.REJECT, completion_events=False, peers=None,
+                 trace=None, profiler=None, control_mode=0o660, control_group=None):
+      """receiver, an optional lwrf.rx, has the messages it decodes broadcast to
+         broadcast_address, and mappings name rooms & devices in JSON events. If
+         control_path is given, local clients (see client.py) may also send messages to a
+         Unix datagram socket there, created with control_mode and owned by control_group
+         if given. metrics and state default to a new Metrics and an
+         in-memory StateStore. max_backlog and backlog_policy bound each pigpio daemon's
+         queue, as for TransmitQueue, and completion_events holds JSON events back until
+         a command is transmitted. peers, a peers.PeerGroup, shares the rooms with other
+         hubs. trace and profiler are a profiling.Trace and Profiler."""
       self._controller = controller
       self._bind_address = bind_address
       self._rx_port = rx_port
       self._tx_port = tx_port
       self._mac_address = mac_address
-
-      self._response_id = 1
+      self._receiver = receiver
+      self._mappings = mappings
+      self._broadcast_address = broadcast_address
+      self._control_path = control_path
+      self._control_mode = control_mode
+      self._control_group = control_group
+      self._control = None
+      self._metrics = metrics if metrics is not None else Metrics()
+      self._state = state if state is not None else StateStore()
+      self._max_backlog = max_backlog
+      self._backlog_policy = backlog_policy
+      self._completion_events = completion_events
+      self._waiting = {} # (room, device) -> [(host, time.monotonic() when queued, sequence)], for completion events
+      self._waiting_lock = threading.RLock()
+      self._sequences = itertools.count(1)
+      self._peers = peers
+      self._trace = trace
+      self._profiler = profiler
+      if receiver is not None:
+        self._metrics.collect('received_duplicates', lambda: receiver.duplicates)
+        self._metrics.collect('received_edges', lambda: receiver.edges)
+        self._metrics.collect('received_discarded', lambda: receiver.discarded)
+
+      self._response_ids = itertools.count(1) # taken from several threads; next() holds the GIL
+      self._parsed = {} # command bytes -> QueuedCommand
 
 
     def start(self):
       self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
       self._socket.bind((self._bind_address, self._rx_port))
-
+      if self._control_path is not None:
+        self._control = self._bind_control()
+      if self._peers is not None:
+        self._peers.start()
+
+      self._queue = ShardedQueue({shard: TransmitQueue(self._send, self._metrics, f'piwaverf-tx-{shard}', self._airtime,
+                                                       self._max_backlog, self._backlog_policy, self._dropped,
+                                                       self._controller.max_burst)
+                                  for shard in self._controller.shards()}, self._controller.shard)
+      if self._receiver is not None:
+        threading.Thread(target=self._publish_received, name='piwaverf-rx', daemon=True).start()
+      if self._control is not None:
+        threading.Thread(target=self._serve_control, name='piwaverf-control', daemon=True).start()
+      buffer = bytearray(self._MAX_DATAGRAM)
+      view = memoryview(buffer)
       try:
-        with ThreadPoolExecutor(max_workers=1) as executor:
-          while True:
-            data, from_host = self._socket.recvfrom(1024)
-            if not data:
-              break
-
-            response = self._handle_message(data, executor)
-            self._socket.sendto(self._format_simple_response_message(response), (from_host[0], self._tx_port))
-            if response.status == ResponseStatus.OK:
-              self._socket.sendto(self._format_json_response_message(response), (from_host[0], self._tx_port))
-              self._response_id += 1
+        while True:
+          length, from_host = self._socket.recvfrom_into(buffer)
+          if not length:
+            break
+
+          received = time.perf_counter()
+          data = view[:length]
+          try:
+            reply = self._query(data)
+            if reply is not None:
+              self._socket.sendto(reply, from_host)
+              continue
+            response = self._handle_message(data, from_host[0])
+            if response is not None:
+              self._respond(response, from_host[0])
+          except Exception as e:
+            print(f'Failed to handle message {bytes(data)}: {e}')
+            continue
+          self._metrics.observe('handle_seconds', time.perf_counter() - received)
 
       except OSError:
         self._socket.close()
+      finally:
+        if self._peers is not None:
+          self._peers.stop()
+        self._close_control()
+        self._queue.shutdown()
+        print(f'Transmit queues stopped, {self._queue.coalesced} commands coalesced')
+
+
+    def _respond(self, response, host):
+      self._sendto(self._format_simple_response_message(response), host)
+      if response.status == ResponseStatus.OK and not self._completion_events:
+        for event in [response] + (response.batch or []):
+          self._sendto(self._format_json_response_message(event), host)
+
+
+    def _sendto(self, message, host):
+      self._socket.sendto(message, (host, self._tx_port))
+
+
+    def _sendto_threadsafe(self, message, host):
+      """_sendto(), callable from the transmit queues' threads."""
+      self._sendto(message, host)
+
+
+    def _bind_control(self):
+      if os.path.lexists(self._control_path):
+        if not stat.S_ISSOCK(os.lstat(self._control_path).st_mode):
+          raise OSError(errno.EEXIST, f'{self._control_path} exists and is not a socket')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as probe:
+          try:
+            probe.connect(self._control_path)
+          except ConnectionRefusedError:
+            os.remove(self._control_path) # left behind by an earlier run
+          else:
+            raise OSError(errno.EADDRINUSE, f'Another hub is accepting commands on {self._control_path}')
+      control = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      control.bind(self._control_path)
+      if self._control_group is not None:
+        os.chown(self._control_path, -1, grp.getgrnam(self._control_group).gr_gid)
+      os.chmod(self._control_path, self._control_mode)
+      print(f'Accepting commands on {self._control_path}')
+      return control
+
+
+    def _serve_control(self):
+      while True:
+        try:
+          data, from_address = self._control.recvfrom(1024)
+        except OSError:
+          return
+        self._control_received(data, from_address)
+
+
+    def _control_received(self, data, from_address):
+      try:
+        reply = self._control_query(data)
+        if reply is None:
+          reply = self._query(data)
+        if reply is None:
+          reply = self._format_simple_response_message(self._handle_message(data))
+      except Exception as e:
+        print(f'Failed to handle control message {data}: {e}')
+        return
+      if from_address:
+        try:
+          self._control_sendto(reply, from_address)
+        except OSError as e:
+          print(f'Failed to reply to control client: {e}')
+
+
+    def _control_query(self, data):
+      """Returns the reply to a query only taken from local clients, or None if data is
+         not one."""
+      query = bytes(data).strip()
+      if query == b'@profile' and self._profiler is not None:
+        return self._profiler.toggle().encode('utf-8')
+      if query == b'@trace' and self._trace is not None:
+        return self._trace.json().encode('utf-8')
+      return None
+
+
+    def _query(self, data):
+      """Returns the reply to an '@' query, or None if data is not one."""
+      if data[:1] != b'@':
+        return None
+      query = bytes(data).strip()
+      if query == b'@stats':
+        return self._metrics.prometheus().encode('utf-8')
+      if query.split(b' ', 1)[0] == b'@state':
+        target = self._TARGET.fullmatch(query[len(b'@state'):].strip() or b'R0')
+        if target is not None:
+          return self._format_json_states(int(target.group(1)), int(target.group(2)) if target.group(2) else None)
+      return self._format_simple_response_message(
+        Response(0, ResponseStatus.ERROR, error_code=2, error_message='Unknown query'))
+
+
+    def _control_sendto(self, message, address):
+      self._control.sendto(message, address)
+
+
+    def _close_control(self):
+      if self._control is not None:
+        self._control.close()
+        self._control = None
+        try:
+          os.remove(self._control_path)
+        except OSError:
+          pass
+
+
+    def _publish_received(self):
+      for message in self._receiver:
+        self._broadcast_received(message)
+
+
+    def _broadcast_received(self, message):
+      received = self._controller.decode(message)
+      if received is None or received.transmitter_id == self._controller.transmitter_id:
+        return # the hub's own transmissions are heard by a receiver next to it
+      print(f'Received {received}')
+      if self._state.use_received:
+        self._state.record(received.room_number, received.device_number, received.command, received.argument, StateStore.RECEIVED)
+      try:
+        self._sendto(self._format_json_received_message(received), self._broadcast_address)
+      except OSError as e:
+        print(f'Failed to broadcast received message: {e}')
+
+
+    def _format_json_received_message(self, received):
+      json_command = self._JSON_FUNCTIONS.get(received.command, 'unknown')
+
+      names = self._format_json_names(received.room_number, received.device_number)
+      message = f'*!{{"trans":{next(self._response_ids)},"mac":"{self._mac_address[9:]}","time":{int(time.time())},"pkt":"433R","tx":"{received.transmitter_id}","fn":"{json_command}","room":{received.room_number} ,"dev":{received.device_number or 0},"param":{received.argument}{names}}}'
+      return message.encode('utf-8')
+
+
+    def _format_json_names(self, room_number, device_number):
+      """The roomName and devName fields for a JSON event, where the mappings name them."""
+      if self._mappings is None:
+        return ''
+      if device_number is None:
+        room_name = self._mappings.room_name(room_number)
+        return f',"roomName":{json.dumps(room_name)}' if room_name is not None else ''
+      name = self._mappings.device_name(room_number, device_number)
+      if name is None:
+        return ''
+      return f',"roomName":{json.dumps(name[0])},"devName":{json.dumps(name[1])}'
 
 
     def _format_simple_response_message(self, response):
       message = f'{int(response.transaction_id)},{response.status}' 
       if response.status == ResponseStatus.ERROR:
-        message += ',{response.error_code},"{response.error_message}"'
+        message += f',{response.error_code},"{response.error_message}"'
       return message.encode('utf-8')
 
 
-    def _format_json_response_message(self, response):
-      json_command = 'unknown'
-      if response.command == LightCommand.On:
-        json_command = 'on'
-      elif response.command == LightCommand.Off:
-        json_command = 'off'
-      elif response.command == LightCommand.Dim:
-        json_command = 'dim'
+    def _format_json_states(self, room_number, device_number):
+      """The known states as a JSON object, for all rooms if room_number is 0, else for
+         one room or one device."""
+      states = []
+      for (room, device), state in self._state.states():
+        if room_number and (room != room_number or (device_number is not None and device != device_number)):
+          continue
+        names = self._format_json_names(room, device)
+        states.append(f'{{"room":{room},"dev":{device or 0},"fn":"{self._JSON_FUNCTIONS.get(state.command, "unknown")}",'
+                      f'"param":{state.argument},"time":{int(state.updated)},"pkt":"{state.source}"{names}}}')
+      return f'{{"states":[{",".join(states)}]}}'.encode('utf-8')
+
 
-      message = f'*!{{"trans":{self._response_id},"mac":"{self._mac_address[9:]}","time":{int(time.time())},"pkt":"433T","fn":"{json_command}","room":{response.room_number} ,"dev":{response.device_number},"param":{response.argument}}}'
+    def _format_json_response_message(self, response, completion=''):
+      json_command = self._JSON_FUNCTIONS.get(response.command, 'unknown')
+
+      names = self._format_json_names(response.room_number, response.device_number)
+      message = f'*!{{"trans":{next(self._response_ids)},"mac":"{self._mac_address[9:]}","time":{int(time.time())},"pkt":"433T","fn":"{json_command}","room":{response.room_number} ,"dev":{response.device_number or 0},"param":{response.argument}{names}{completion}}}'
       return message.encode('utf-8')
 
+
+    def _format_json_completion(self, status, queued, airtime=None, error=None):
+      """The fields a completion event adds to a JSON event, with times in seconds."""
+      fields = f',"status":"{status}","queued":{round(queued * 1000)}'
+      if airtime is not None:
+        fields += f',"onAir":{round(airtime * 1000)}'
+      if error is not None:
+        fields += f',"error":{json.dumps(error)}'
+      return fields
+
     
-    def _handle_message(self, data, executor):
-      message = data.decode('utf-8')
+    def _handle_message(self, data, host=None):
+      """Parses a datagram, given as bytes or any bytes-like object, and queues its
+         commands. Returns the Response to send, with an ERR status for anything
+         that cannot be parsed. host, if given, is sent the completion events.
+         Returns None if the message from host is for another hub among the peers."""
+      match = self._MESSAGE.fullmatch(data)
+      if match is None:
+        if self._deferred(0, host):
+          return None
+        print(f'Malformed message: {bytes(data)}')
+        transaction = self._TRANSACTION.match(data)
+        return self._error(int(transaction.group(1) or 0), 1, 'Malformed message')
+      transaction_id = int(match.group(1) or 0)
+      segment = match.group(2)
+
+      accepted = ()
+      try:
+        if segment is not None:
+          queued = self._parse_segment(segment, match.group(3, 4, 5, 6, 7))
+          if self._deferred(queued.room_number, host):
+            return None
+          accepted = (queued,)
+          self._trace_start(accepted)
+          self._submit(accepted, host)
+          self._metrics.count('commands')
+          return Response(transaction_id, ResponseStatus.OK, queued.room_number, queued.device_number, queued.command, queued.argument)
+
+        segments = match.group(8)
+        if segments.startswith(b'F'):
+          if self._deferred(0, host):
+            return None
+          print(f'Pairing command, ignoring {bytes(data)}')
+          return Response(transaction_id, ResponseStatus.OK)
+
+        # several !-separated commands in one message are sent as a single burst
+        commands = []
+        for segment in segments.split(b'!'):
+          queued = self._parse_segment(segment)
+          if queued is None:
+            if self._deferred(0, host):
+              return None
+            print(f'Unrecognised command: {segment}')
+            return self._error(transaction_id, 2, 'Unrecognised command')
+          commands.append(queued)
+        if self._deferred(commands[0].room_number, host):
+          return None
+        accepted = commands
+        self._trace_start(accepted)
+        self._submit(accepted, host)
+      except ValueError as e:
+        if self._deferred(0, host):
+          return None
+        print(f'Invalid command in {bytes(data)}: {e}')
+        return self._error(transaction_id, 3, str(e))
+      except BacklogFull as e:
+        print(f'Refused {bytes(data)}: {e}')
+        self._trace_stage(accepted, 'refused', True)
+        self._metrics.count('busy')
+        return self._error(transaction_id, 4, 'Busy')
+
+      self._metrics.count('commands', len(commands))
+
+      responses = [Response(transaction_id, ResponseStatus.OK, queued.room_number, queued.device_number, queued.command, queued.argument)
+                   for queued in commands]
+      responses[0].batch = responses[1:]
+      return responses[0]
+
+
+    def _trace_start(self, commands):
+      if self._trace is None:
+        return
+      for command in commands:
+        self._trace.start(command.key, room=command.room_number, dev=command.device_number or 0,
+                          fn=self._JSON_FUNCTIONS.get(command.command, 'unknown'), param=command.argument)
+
+
+    def _trace_stage(self, commands, stage, finished=False, **fields):
+      if self._trace is None:
+        return
+      for command in commands:
+        self._trace.stage(command.key, stage, finished, **fields)
+
+
+    def _deferred(self, room_number, host):
+      """Returns True if a message for room_number from host is left to another hub."""
+      if self._peers is None or host is None or self._peers.owns(room_number):
+        return False
+      self._metrics.count('deferred')
+      return True
+
+
+    def _error(self, transaction_id, error_code, error_message):
+      self._metrics.count('errors')
+      return Response(transaction_id, ResponseStatus.ERROR, error_code=error_code, error_message=error_message)
+
+
+    def _parse_segment(self, segment, groups=None):
+      """Returns the QueuedCommand for one RnDnF... or RnF... command, given its bytes and,
+         if already matched, its groups. Returns None if the command is not recognised and
+         raises ValueError if it does not apply to its target or is out of range."""
+      queued = self._parsed.get(segment)
+      if queued is not None:
+        return queued
+      if groups is None:
+        match = self._SEGMENT.fullmatch(segment)
+        if match is None:
+          return None
+        groups = match.groups()
+      room, device, function, level, mood = groups
+
+      room_number = int(room)
+      device_number = int(device) if device is not None else None
+      command = self._FUNCTIONS.get(function)
+      argument = 0
+      if command is None:
+        if level is not None:
+          command, argument = LightCommand.Dim, int(level)
+        else:
+          command, argument = LightCommand.Mood, int(mood)
+      if (device_number is None) != (command in (LightCommand.AllOff, LightCommand.Mood)):
+        raise ValueError(f'Function {function.decode()} does not apply to {"a room" if device_number is None else "a device"}')
+      Controller.validate(room_number, device_number, command, argument)
+
+      queued = QueuedCommand(room_number, device_number, command, argument)
+      if len(self._parsed) >= self._PARSED_CACHE_SIZE:
+        self._parsed.clear()
+      self._parsed[segment] = queued
+      return queued
+
+
+    def _submit(self, commands, host):
+      """Queues QueuedCommands, as a QueuedBatch if there are several, registering host
+         for their completion events."""
+      if not self._completion_events or host is None:
+        self._queue.submit(QueuedBatch(commands) if len(commands) > 1 else commands[0])
+        return
+
+      # each command is numbered, so a later one for the same device queued while this
+      # is being sent does not take its events; numbering and queueing together keeps
+      # the numbers in the order the backlog sees the commands
+      submitted = time.monotonic()
+      with self._waiting_lock:
+        commands = [replace(command, sequence=next(self._sequences)) for command in commands] # parsed commands are shared
+        for command in commands:
+          self._waiting.setdefault(command.key, []).append((host, submitted, command.sequence))
+        try:
+          self._queue.submit(QueuedBatch(commands) if len(commands) > 1 else commands[0])
+        except BacklogFull:
+          for command in commands:
+            waiters = self._waiting[command.key]
+            waiters.remove((host, submitted, command.sequence))
+            if not waiters:
+              del self._waiting[command.key]
+          raise
+
+
+    def _take_waiting(self, commands):
+      """Removes and returns the hosts awaiting the completion of QueuedCommands, as
+         {key: [(host, queued time)]}: those of each command and of the earlier ones
+         for its device which it superseded."""
+      if not self._completion_events:
+        return {}
+      waiting = {}
+      with self._waiting_lock:
+        for command in commands:
+          waiters = self._waiting.get(command.key, ())
+          waiting[command.key] = [(host, submitted) for host, submitted, sequence in waiters if sequence <= command.sequence]
+          waiters = [waiter for waiter in waiters if waiter[2] > command.sequence]
+          if waiters:
+            self._waiting[command.key] = waiters
+          else:
+            self._waiting.pop(command.key, None)
+      return waiting
+
+
+    def _complete(self, waiting, commands, began, status, airtime=None, error=None):
+      """Sends the completion events of QueuedCommands whose transmission began at
+         time.monotonic() began, to the hosts in waiting from _take_waiting()."""
+      now = time.monotonic()
+      for command in commands:
+        for host, submitted in waiting.get(command.key, ()):
+          if status == 'sent':
+            self._metrics.observe('completion_seconds', now - submitted)
+          response = Response(0, ResponseStatus.OK, command.room_number, command.device_number, command.command, command.argument)
+          completion = self._format_json_completion(status, max(0.0, began - submitted), airtime, error)
+          try:
+            self._sendto_threadsafe(self._format_json_response_message(response, completion), host)
+          except OSError as e:
+            print(f'Failed to send completion event: {e}')
+
+
+    def _dropped(self, dropped):
+      """Sends the completion events of pending QueuedCommands and QueuedBatches
+         dropped from a full backlog."""
+      commands = [command for queued in dropped for command in (queued.commands if isinstance(queued, QueuedBatch) else (queued,))]
+      self._complete(self._take_waiting(commands), commands, time.monotonic(), 'dropped')
+      self._trace_stage(commands, 'dropped', True)
+
+
+    def _airtime(self, queued):
+      """The estimated seconds on air of a QueuedCommand or QueuedBatch."""
+      commands = queued.commands if isinstance(queued, QueuedBatch) else (queued,)
+      return self._controller.airtime([(command.room_number, command.device_number, command.command, command.argument)
+                                       for command in commands])
+
+
+    def _send(self, pending):
+      """Transmits a list of pending QueuedCommands and QueuedBatches together, with
+         their repeats interleaved. Where a device appears more than once, only its
+         newest command is sent. Redundant commands are skipped or shortened as the
+         state store's policy says."""
+      start = time.perf_counter()
+      began = time.monotonic()
+      latest = OrderedDict()
+      for queued in pending:
+        for command in (queued.commands if isinstance(queued, QueuedBatch) else (queued,)):
+          latest.pop(command.key, None)
+          latest[command.key] = command
+      waiting = self._take_waiting(latest.values())
+      self._trace_stage(latest.values(), 'sending')
+
+      commands = []
+      profiles = []
+      for command in latest.values():
+        profile = None
+        if self._state.policy != StateStore.SEND and self._state.redundant(
+            command.room_number, command.device_number, command.command, command.argument):
+          if self._state.policy == StateStore.SKIP:
+            print(f'Skipping command {command.command} to device {command.device_number} in room {command.room_number}, already sent')
+            self._metrics.count('skipped')
+            self._complete(waiting, [command], began, 'skipped')
+            self._trace_stage([command], 'skipped', True)
+            continue
+          profile = TransmitProfile(self._state.shortened_repeat)
+          self._metrics.count('shortened')
+        commands.append(command)
+        profiles.append(profile)
+      if not commands:
+        return
 
-      transaction_id = ''
-      message_offset = 0
+      try:
+        if len(commands) == 1:
+          command = commands[0]
+          print(f'Sending command {command.command} with argument {command.argument} to device {command.device_number} in room {command.room_number}')
+          airtime = self._controller.send(command.room_number, command.device_number, command.command, command.argument, profiles[0])
+        else:
+          print(f'Sending {len(commands)} commands with their repeats interleaved')
+          airtime = self._controller.send_many([(command.room_number, command.device_number, command.command, command.argument)
+                                               for command in commands], profiles)
+      except Exception as e:
+        self._complete(waiting, commands, began, 'failed', error=str(e))
+        self._trace_stage(commands, 'failed', True, error=str(e))
+        raise
+      for command in commands:
+        self._state.record(command.room_number, command.device_number, command.command, command.argument)
+      self._complete(waiting, commands, began, 'sent', airtime)
+      self._trace_stage(commands, 'sent', True, airtime=round(airtime * 1000, 3))
+      self._metrics.observe('send_seconds', time.perf_counter() - start)
+ 
 
-      if message[message_offset] == ':': # MAC prefix, ignore at present
-        while message[message_offset] != ',':
-          message_offset += 1
-        message_offset += 1
+    def shutdown(self):
+      self._socket.close()
+      self._close_control()
 
-      while message[message_offset] != ',':
-        transaction_id += message[message_offset]
-        message_offset += 1
-      if len(transaction_id) == 0:
-        transaction_id = '0'
 
-      if message[message_offset] != ',' and message[message_offset + 1] != '!':
-        print(f'Malformed message: {message}')
-        return Response(transaction_id, ResponseStatus.ERROR, 1, 'Malformed message')
-      message_offset += 2
+class AsyncTransmitQueue:
+  """asyncio counterpart to TransmitQueue, also handing send a list of the pending
+     commands. Blocking sends are run in the loop's default executor so the loop is
+     never held up by a transmission."""
 
-      if message[message_offset] == 'R' and message[message_offset + 2] == 'D' and message[message_offset + 4] == 'F':
-        room_number = int(message[message_offset + 1])
-        device_number = int(message[message_offset + 3])
 
-        function = ''
-        message_offset += 5
-        while message_offset < len(message) and message[message_offset] != '|':
-          function += message[message_offset]
-          message_offset += 1
+  def __init__(self, send, metrics=None, estimate=None, max_backlog=None, policy=CommandBacklog.REJECT, on_dropped=None,
+               max_burst=None):
+    self._send = send
+    self._metrics = metrics if metrics is not None else Metrics()
+    self._estimate = estimate
+    self._max_backlog = max_backlog
+    self._max_burst = max_burst
+    self._policy = policy
+    self._on_dropped = on_dropped
+    self._backlog = CommandBacklog()
+    self._ready = None
+    self._task = None
+    self._closing = False
 
-        command = self._parse_command(function)
-        if command is not None:
-          executor.submit(self._send, room_number, device_number, command.identitifer, command.argument)
-          return Response(transaction_id, ResponseStatus.OK, room_number, device_number, command.identitifer, command.argument)
 
-      elif message[message_offset] == 'F':
-        print(f'Pairing command, ignoring {message}')
-        return Response(transaction_id, ResponseStatus.OK)
+  @property
+  def coalesced(self):
+    return self._backlog.coalesced
 
-      return Response(transaction_id, ResponseStatus.ERROR, 2, 'Unrecognised command')
 
+  def start(self):
+    self._ready = asyncio.Event()
+    self._task = asyncio.get_running_loop().create_task(self._run())
 
-    def _send(self, room_number, device_number, command, argument):
-      print(f'Sending command {command} with argument {argument} to device {device_number} in room {room_number}')
-      self._controller.send(room_number, device_number, command, argument)
- 
 
-    def _parse_command(self, function):
-      if function == '0':
-        return ParsedCommand(LightCommand.Off)
-      elif function == '1':
-        return ParsedCommand(LightCommand.On)
-      elif function.startswith('dP'):
-        dim_level = int(function[2:])
-        return ParsedCommand(LightCommand.Dim, dim_level)
-      else:
-        print(f'Unknown function in message: {function}')
-        return None
+  def fits(self, command):
+    if self._max_backlog is None or self._policy == CommandBacklog.DROP_OLDEST:
+      return True
+    return self._backlog.fits(command, self._estimate(command), self._max_backlog)
+
+
+  def submit(self, command):
+    if self._task is None or self._closing:
+      raise RuntimeError('Transmit queue is not running')
+    airtime = self._estimate(command) if self._max_backlog is not None or self._max_burst is not None else 0.0
+    superseded, dropped = self._backlog.admit(command, airtime, self._max_backlog, self._policy)
+    _count_admission(self._metrics, command, superseded, dropped, self.coalesced, self._on_dropped)
+    self._ready.set()
+
+
+  async def _run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      while not self._backlog:
+        if self._closing:
+          return
+        self._ready.clear()
+        await self._ready.wait()
+      pending = self._backlog.pop_burst(self._max_burst)
+
+      now = time.monotonic()
+      for command, submitted in pending:
+        self._metrics.observe('queue_wait_seconds', now - submitted)
+      commands = [command for command, submitted in pending]
+      try:
+        await loop.run_in_executor(None, self._send, commands)
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        self._metrics.count('dropped', len(commands))
+        print(f'Failed to send commands {commands}: {e}')
+
+
+  async def shutdown(self, drain=True):
+    """Stops the worker, by default once all pending commands have been sent."""
+    if self._task is None:
+      return
+    self._closing = True
+    self._ready.set()
+    if not drain:
+      self._task.cancel()
+    try:
+      await self._task
+    except asyncio.CancelledError:
+      pass
+    self._metrics.count('dropped', len(self._backlog))
+
+
+class _HubProtocol(asyncio.DatagramProtocol):
+
+  def __init__(self, received):
+    self._received = received
+
+
+  def datagram_received(self, data, addr):
+    if data:
+      self._received(data, addr)
+
+
+  def error_received(self, exc):
+    print(f'UDP error: {exc}')
+
+
+class AsyncHub(Hub):
+    """Hub serving the UDP protocol from an asyncio event loop. Datagrams are
+       acknowledged as soon as they are parsed, independently of any transmission
+       in progress."""
+
+
+    def start(self):
+      asyncio.run(self.serve())
+
+
+    async def serve(self):
+      loop = asyncio.get_running_loop()
+      self._loop = loop
+      self._serve_task = asyncio.current_task()
+
+      self._queue = ShardedQueue({shard: AsyncTransmitQueue(self._send, self._metrics, self._airtime,
+                                                            self._max_backlog, self._backlog_policy, self._dropped,
+                                                            self._controller.max_burst)
+                                  for shard in self._controller.shards()}, self._controller.shard)
+      for queue in self._queue.queues.values():
+        queue.start()
+      if self._peers is not None:
+        await loop.run_in_executor(None, self._peers.start)
+      self._transport, _ = await loop.create_datagram_endpoint(
+        lambda: _HubProtocol(self._datagram_received), local_addr=(self._bind_address, self._rx_port), allow_broadcast=True)
+      if self._control_path is not None:
+        self._control = self._bind_control()
+        self._control_transport, _ = await loop.create_datagram_endpoint(
+          lambda: _HubProtocol(self._control_received), sock=self._control)
+      publisher = None
+      if self._receiver is not None:
+        publisher = loop.create_task(self._publish_received_async())
+
+      try:
+        await loop.create_future() # runs until cancelled
+      except asyncio.CancelledError:
+        pass
+      finally:
+        if publisher is not None:
+          publisher.cancel()
+        if self._peers is not None:
+          await loop.run_in_executor(None, self._peers.stop)
+        self._transport.close()
+        if self._control is not None:
+          self._control_transport.close()
+          self._close_control()
+        await asyncio.gather(*(queue.shutdown() for queue in self._queue.queues.values()))
+        print(f'Transmit queues stopped, {self._queue.coalesced} commands coalesced')
+
+
+    async def _publish_received_async(self):
+      async for message in self._receiver:
+        self._broadcast_received(message)
+
+
+    def _datagram_received(self, data, from_host):
+      received = time.perf_counter()
+      try:
+        reply = self._query(data)
+        if reply is not None:
+          self._transport.sendto(reply, from_host)
+          return
+        response = self._handle_message(data, from_host[0])
+        if response is not None:
+          self._respond(response, from_host[0])
+      except Exception as e:
+        print(f'Failed to handle message {data}: {e}')
+        return
+      self._metrics.observe('handle_seconds', time.perf_counter() - received)
+
+
+    def _sendto(self, message, host):
+      self._transport.sendto(message, (host, self._tx_port))
+
+
+    def _sendto_threadsafe(self, message, host):
+      self._loop.call_soon_threadsafe(self._transport.sendto, message, (host, self._tx_port))
+
+
+    def _control_sendto(self, message, address):
+      self._control_transport.sendto(message, address)
 
 
     def shutdown(self):
-      self._socket.close()
+      """May be called from a signal handler or another thread."""
+      self._loop.call_soon_threadsafe(self._serve_task.cancel)
+
+
+class PigpioConnection:
+  """A pigpio daemon, shared by the transmitters on its Pi. It is connected on first
+     use, from the thread about to transmit, so a Pi which cannot be reached only holds
+     up its own transmit queue; after a failure it is retried at most every
+     RETRY_INTERVAL seconds."""
+
+  RETRY_INTERVAL = 30.0
+
+
+  def __init__(self, host=None, port=None, connect=None, pi=None):
+    """connect(host, port) returns a new connection, by default a pigpio.pi. pi is an
+       existing connection to use first."""
+    self.host = host
+    self.port = port
+    self.name = 'local' if host is None else host if port is None else f'{host}:{port}'
+    self.transmitters = []
+    self.pi = None
+    self.clock = time
+    self._connect = connect if connect is not None else self._connect_pigpio
+    self._given = pi
+    self._retry = 0
+    self._dropped = False
+    self._lock = threading.Lock()
+
+
+  def open(self):
+    """Returns the connection, connecting and creating the transmitters' lwrf.tx if
+       needed. Raises RuntimeError if the daemon cannot be reached."""
+    with self._lock:
+      if self.pi is not None:
+        return self.pi
+      if self._given is not None:
+        pi, self._given = self._given, None
+      else:
+        if time.monotonic() < self._retry:
+          raise RuntimeError(f'pigpiod {self.name} is unavailable, retrying in {self._retry - time.monotonic():.0f}s')
+        self._retry = time.monotonic() + self.RETRY_INTERVAL
+        print(f'Connecting to pigpiod {self.name}')
+        pi = self._connect(self.host, self.port)
+        if not getattr(pi, 'connected', True):
+          raise RuntimeError(f'Cannot connect to pigpiod {self.name}')
+      if self._dropped:
+        pi.wave_clear() # waveforms left from the lost connection
+        self._dropped = False
+
+      self.clock = getattr(pi, 'clock', time)
+      self._open_transmitters(pi)
+      self.pi = pi
+      return pi
+
+
+  def _open_transmitters(self, pi):
+    for transmitter in self.transmitters:
+      transmitter.tx = lwrf.tx(pi, transmitter.gpio, clock=self.clock, shared_by=len(self.transmitters))
+
+
+  def drop(self):
+    """Forgets a connection which has failed, so the next open() reconnects."""
+    print(f'Lost connection to pigpiod {self.name}')
+    with self._lock:
+      pi, self.pi = self.pi, None
+      for transmitter in self.transmitters:
+        transmitter.tx = None
+      self._retry = 0
+      self._dropped = True
+    if pi is not None:
+      try:
+        pi.stop()
+      except (OSError, struct.error):
+        pass
+
+
+  def close(self):
+    with self._lock:
+      pi, self.pi = self.pi, None
+      for transmitter in self.transmitters:
+        if transmitter.tx is not None:
+          transmitter.tx.cancel()
+          transmitter.tx = None
+    if pi is not None:
+      pi.stop()
+
+
+  @staticmethod
+  def _connect_pigpio(host, port):
+    kwargs = {}
+    if host is not None:
+      kwargs['host'] = host
+    if port is not None:
+      kwargs['port'] = port
+    return pigpio.pi(**kwargs)
+
+
+class ProcessConnection(PigpioConnection):
+  """The local pigpio daemon, with its transmitters run by a txprocess.TransmitProcess
+     configured by config. The connection itself is kept for receivers and must not
+     create waveforms of its own."""
+
+
+  def __init__(self, config, connect=None, pi=None):
+    super().__init__(None, None, connect, pi)
+    self._config = config
+    self._process = None
+
+
+  def _open_transmitters(self, pi):
+    if self._process is None:
+      self._process = txprocess.TransmitProcess([transmitter.gpio for transmitter in self.transmitters], self._config)
+    for index, transmitter in enumerate(self.transmitters):
+      transmitter.tx = self._process.tx(index)
+
+
+  def drop(self):
+    super().drop()
+    self._dropped = False # the waveforms belong to the transmit process
+
+
+  def close(self):
+    super().close()
+    if self._process is not None:
+      self._process.stop()
+      self._process = None
+
+
+class DutyCycle:
+  """Limits time on air to a fraction of any rolling window."""
+
+
+  def __init__(self, fraction, window):
+    self.fraction = fraction
+    self.window = window
+    self._bursts = deque() # (end, seconds on air), oldest first
+    self._used = 0.0
+
+
+  def delay(self, airtime, now):
+    """Returns the seconds to wait before transmitting for airtime seconds."""
+    self._expire(now)
+    budget = self.fraction * self.window
+    used = self._used
+    wait = 0.0
+    for end, seconds in self._bursts:
+      if used + airtime <= budget:
+        break
+      used -= seconds
+      wait = end + self.window - now
+    return wait
+
+
+  def record(self, airtime, end):
+    self._bursts.append((end, airtime))
+    self._used += airtime
+
+
+  def _expire(self, now):
+    while self._bursts and self._bursts[0][0] <= now - self.window:
+      self._used -= self._bursts.popleft()[1]
+
+
+class Transmitter:
+  """A transmit GPIO on a pigpio daemon. tx is its lwrf.tx while connected, else None.
+     duty is its DutyCycle, if limited."""
+
+
+  def __init__(self, name, gpio, connection, duty=None):
+    self.name = name
+    self.gpio = gpio
+    self.connection = connection
+    self.duty = duty
+    self.tx = None
+    connection.transmitters.append(self)
 
 
 class Controller:
 
   _DEFAULT_TX_GPIO_PIN = 18
   _DEFAULT_TX_REPEAT = 12
-
-
-  def __init__(self, transmitter_id, tx_gpio_pin=_DEFAULT_TX_GPIO_PIN, tx_repeat=_DEFAULT_TX_REPEAT):
+  _DEFAULT_MAX_BURST = 2.0 # seconds
+  _DEFAULT_DUTY_WINDOW = 60.0 # seconds
+
+  # room-level commands address the unit above the last device
+  _ROOM_UNIT = 15
+  _ALL_OFF_ARGUMENT = 0xC0
+  _MOOD_ARGUMENT_BASE = 0x81
+  _MAX_MOOD = 30
+  _MAX_DIM = 32
+
+
+  def __init__(self, transmitter_id, tx_gpio_pin=_DEFAULT_TX_GPIO_PIN, tx_repeat=_DEFAULT_TX_REPEAT, pi=None, metrics=None,
+               mappings=None, max_burst=_DEFAULT_MAX_BURST, transmitters=None, connect=None, duty_cycle=None,
+               duty_window=_DEFAULT_DUTY_WINDOW, tx_process=None):
+    """pi is the connection to the local pigpiod, by default a new pigpio.pi(). Any object
+       implementing the same methods, such as sim.SimulatedPi, may be given instead; if it
+       has a clock attribute, that is used in place of the time module. Waveform build
+       times, airtime and repeats are recorded in metrics, if given. Repeat and gap
+       overrides for rooms and devices are taken from mappings, if given. send_many()
+       splits its commands into bursts of at most max_burst seconds on air.
+
+       transmitters is a list of TransmitterConfigs, by default one on tx_gpio_pin of the
+       local pigpiod; remote daemons are connected with connect(host, port), by default
+       pigpio.pi. Each transmitter is on air for at most duty_cycle of any duty_window
+       seconds, if given. tx_process, a txprocess.TransmitProcessConfig, runs the local
+       transmitters in a process of their own."""
     if len(transmitter_id) != 5:
       raise ValueError(f'Transmitter ID must be five hex characters, found: {transmitter_id}')
     self._transmitter_id = transmitter_id
     self._tx_repeat = tx_repeat
-
-    self._pi = pigpio.pi()
-    self._tx = lwrf.tx(self._pi, tx_gpio_pin)
+    self._max_burst = max_burst
+    self._mappings = mappings
+    self._metrics = metrics if metrics is not None else Metrics()
+
+    self._connections = {} # (host, port) -> PigpioConnection
+    self._transmitters = {} # name -> Transmitter
+    for config in transmitters or [TransmitterConfig('default')]:
+      key = (config.host, config.port)
+      if key not in self._connections:
+        if key == (None, None) and tx_process is not None:
+          self._connections[key] = ProcessConnection(tx_process, connect, pi)
+        else:
+          self._connections[key] = PigpioConnection(config.host, config.port, connect, pi if key == (None, None) else None)
+      gpio = config.gpio if config.gpio is not None else tx_gpio_pin
+      duty = DutyCycle(duty_cycle, duty_window) if duty_cycle is not None else None
+      self._transmitters[config.name] = Transmitter(config.name, gpio, self._connections[key], duty)
+    self._default = next(iter(self._transmitters.values()))
+
+    self._pi = self._tx = None
+    self._clock = time
+    local = self._connections.get((None, None))
+    if local is not None:
+      self._pi = local.open()
+      self._clock = local.clock
+      if self._default.connection is local:
+        self._tx = self._default.tx
+    self._receivers = []
+
+    for name, counter in (('tx_cache_hits', 'cacheHits'), ('tx_cache_misses', 'cacheMisses'),
+                          ('tx_cache_evictions', 'cacheEvictions')):
+      self._metrics.collect(name, lambda counter=counter: self._tx_counters(counter), 'transmitter')
 
 
   def shutdown(self):
-    self._tx.cancel()
-    self._pi.stop()
-    time.sleep(2)
+    for receiver in self._receivers:
+      receiver.cancel()
+    for connection in self._connections.values():
+      connection.close()
+    self._clock.sleep(2)
+
+
+  def receiver(self, rx_gpio_pin, dedup_ttl=lwrf.RX_DEDUP_TTL):
+    """Returns a lwrf.rx receiving on the given GPIO of the local pigpiod, which is
+       cancelled on shutdown. Repeats of a message within dedup_ttl microseconds are
+       reported once."""
+    if self._pi is None:
+      raise RuntimeError('Receiving needs a transmitter on the local pigpiod')
+    receiver = lwrf.rx(self._pi, rx_gpio_pin, 0, dedup_ttl=dedup_ttl)
+    self._receivers.append(receiver)
+    return receiver
+
+
+  def shards(self):
+    """Returns the names of the pigpio daemons, each of which can transmit in parallel
+       with the others."""
+    return [connection.name for connection in self._connections.values()]
+
+
+  def _tx_counters(self, counter):
+    """The named counter of each connected transmitter's lwrf.tx, by transmitter name."""
+    return {transmitter.name: getattr(transmitter.tx, counter)
+            for transmitter in self._transmitters.values() if transmitter.tx is not None}
+
+
+  @property
+  def max_burst(self):
+    return self._max_burst
+
 
+  @property
+  def transmitter_id(self):
+    """The transmitter ID, as decode() reports it."""
+    return self._transmitter_id.lower()
 
-  def send(self, udp_room_id, udp_device_number, command, command_argument=None):
+
+  def shard(self, udp_room_id):
+    """Returns the name of the pigpio daemon which transmits to a room."""
+    return self._transmitter(udp_room_id).connection.name
+
+
+  @classmethod
+  def decode(cls, message):
+    """Converts a received radio message back to a UDP-numbered command, or None
+       if it is not a light command."""
+    argument = (message[0] << 4) | message[1]
+    unit_number = message[2]
+    radio_command = message[3]
+    transmitter_id = ''.join(f'{element:x}' for element in message[4:9])
+    room_number = message[9] + 1
+    device_number = unit_number + 1
+
+    if unit_number == cls._ROOM_UNIT:
+      if radio_command == 0 and argument == cls._ALL_OFF_ARGUMENT:
+        return ReceivedCommand(transmitter_id, room_number, None, LightCommand.AllOff)
+      elif radio_command == 2 and argument > cls._MOOD_ARGUMENT_BASE:
+        return ReceivedCommand(transmitter_id, room_number, None, LightCommand.Mood, argument - cls._MOOD_ARGUMENT_BASE)
+      return None
+
+    if radio_command == 0:
+      return ReceivedCommand(transmitter_id, room_number, device_number, LightCommand.Off)
+    elif radio_command == 1:
+      if argument >= 128:
+        return ReceivedCommand(transmitter_id, room_number, device_number, LightCommand.Dim, argument - 127)
+      return ReceivedCommand(transmitter_id, room_number, device_number, LightCommand.On)
+    return None
+
+
+  def send(self, udp_room_id, udp_device_number, command, command_argument=None, profile=None):
+    """Transmits a command with the repeat count and gap of profile, falling back to
+       those from the mappings and then to the defaults. Returns its seconds on air."""
+    transmitter = self._transmitter(udp_room_id)
+    message = self._radio_message(udp_room_id, udp_device_number, command, command_argument)
+    repeat, gap = self._transmit_profile(udp_room_id, udp_device_number, profile)
+    return self._put(transmitter, [(message, repeat, gap)])
+
+
+  def send_many(self, commands, profiles=None):
+    """Transmit (room, device, command, argument) tuples with their repeats interleaved
+       round robin, so every device hears its first frame near the start of the burst.
+       Each message keeps the repeat count and gap of its device's profile. Commands are
+       split into consecutive bursts of at most max_burst seconds on air, though a
+       burst always holds at least one command. Commands for rooms on different
+       transmitters are sent from each in turn. profiles, if given, holds a
+       TransmitProfile or None for each command, as for send(). Returns the total seconds
+       on air."""
+    groups = OrderedDict() # Transmitter -> (command, profile)s
+    for command, profile in zip(commands, profiles or [None] * len(commands)):
+      groups.setdefault(self._transmitter(command[0]), []).append((command, profile))
+
+    total = 0.0
+    for transmitter, group in groups.items():
+      bursts = [[]]
+      airtime = lwrf.TX_GAP
+      for command, profile in group:
+        message = self._radio_message(*command)
+        repeat, gap = self._transmit_profile(command[0], command[1], profile)
+        micros = repeat * lwrf.tx.micros(message, gap)
+        if bursts[-1] and (airtime + micros) / 1000000 > self._max_burst:
+          bursts.append([])
+          airtime = lwrf.TX_GAP
+        bursts[-1].append((message, repeat, gap))
+        airtime += micros
+
+      for frames in bursts:
+        total += self._put(transmitter, frames)
+    return total
+
+
+  def calibrate(self, receiver, udp_room_id, udp_device_number, command=LightCommand.On, trials=10,
+                max_repeat=_DEFAULT_TX_REPEAT, gaps=(lwrf.TX_GAP, 8000, 6500), required=1.0, settle=0.2):
+    """Finds, for each gap, the fewest repeats with which receiver decodes a command in
+       at least the required fraction of trials. receiver is a lwrf.rx within range of the
+       transmitter, such as one from receiver() on a simulated loopback, reporting every
+       message (a dedup_ttl of 0) as the same command is sent repeatedly. Returns the
+       Calibrations found, with the least airtime first."""
+    expected = bytes(self._radio_message(udp_room_id, udp_device_number, command))
+    transmitter = self._transmitter(udp_room_id)
+    results = []
+    for gap in gaps:
+      for repeat in range(1, max_repeat + 1):
+        decoded = 0
+        for trial in range(trials):
+          while receiver.get() is not None: # anything left from the last trial
+            pass
+          self.send(udp_room_id, udp_device_number, command, profile=TransmitProfile(repeat, gap))
+          transmitter.connection.clock.sleep(settle) # for the last edges to reach the receiver
+          message = receiver.get()
+          while message is not None and message != expected:
+            message = receiver.get()
+          decoded += message is not None
+        print(f'Gap {gap}us, {repeat} repeats: decoded {decoded} of {trials}')
+        if decoded >= required * trials:
+          results.append(Calibration(repeat, gap, decoded / trials, transmitter.tx.lastAirTime))
+          break
+    return sorted(results, key=lambda calibration: calibration.airtime)
+
+
+  def _transmit_profile(self, udp_room_id, udp_device_number, profile=None):
+    """Returns the (repeat, gap) to transmit a command to a device with."""
+    mapped = None
+    if self._mappings is not None:
+      mapped = self._mappings.transmit_profile(udp_room_id, udp_device_number)
+    repeat = gap = None
+    for source in (profile, mapped):
+      if source is not None:
+        repeat = repeat or source.repeat
+        gap = gap or source.gap
+    return repeat or self._tx_repeat, gap or lwrf.TX_GAP
+
+
+  def _transmitter(self, udp_room_id):
+    name = self._mappings.transmitter(udp_room_id) if self._mappings is not None else None
+    return self._transmitters.get(name, self._default) # rooms assigned since startup use the first
+
+
+  def airtime(self, commands):
+    """Returns the estimated seconds on air of (room, device, command, argument) tuples
+       sent as one burst, with the repeat counts and gaps of their profiles."""
+    frames = []
+    for command in commands:
+      repeat, gap = self._transmit_profile(command[0], command[1])
+      frames.append((self._radio_message(*command), repeat, gap))
+    return self._burst_airtime(frames)
+
+
+  @staticmethod
+  def _burst_airtime(frames):
+    return (lwrf.TX_GAP + sum(repeat * lwrf.tx.micros(message, gap) for message, repeat, gap in frames)) / 1000000
+
+
+  def _put(self, transmitter, frames):
+    """Transmits (message, repeat, gap) frames, interleaved, from a transmitter, once
+       its duty cycle allows. Returns the seconds on air, raising TransmitError if
+       nothing was sent."""
+    transmitter.connection.open()
+    clock = transmitter.connection.clock
+    if transmitter.duty is not None:
+      wait = transmitter.duty.delay(self._burst_airtime(frames), clock.monotonic())
+      if wait > 0:
+        print(f'Waiting {wait:.1f}s for the duty cycle of transmitter {transmitter.name}')
+        self._metrics.observe('duty_wait_seconds', wait)
+        clock.sleep(wait)
+    try:
+      result = transmitter.tx.put_interleaved(frames)
+    except (OSError, struct.error):
+      transmitter.connection.drop()
+      raise
+    if transmitter.duty is not None:
+      transmitter.duty.record(transmitter.tx.lastAirTime, clock.monotonic())
+    self._record_transmission(transmitter.tx, [repeat for message, repeat, gap in frames])
+    if result == -2:
+      raise TransmitError(f'Could not create the waveforms on transmitter {transmitter.name}')
+    if result == txprocess.FAILED:
+      raise TransmitError(f'The transmit process could not send from transmitter {transmitter.name}')
+    if result < 0:
+      raise TransmitError(f'Transmitter {transmitter.name} failed with error {result}')
+    return transmitter.tx.lastAirTime
+
+
+  def _record_transmission(self, tx, repeats):
+    self._metrics.observe('waveform_build_seconds', tx.lastBuildTime)
+    self._metrics.observe('airtime_seconds', tx.lastAirTime)
+    if tx.lastFrames: # nothing was sent if the transmission failed
+      for repeat in repeats:
+        self._metrics.observe('repeats', repeat)
+
+
+  @classmethod
+  def validate(cls, udp_room_id, udp_device_number, command, command_argument=None):
+    """Raises ValueError if a command cannot be transmitted."""
     if udp_room_id < 1 or udp_room_id > 8:
       raise ValueError(f'UDP Room ID must be between 1 and 8 inclusive, currently {udp_room_id}')
-    if udp_device_number < 1 or udp_device_number > 15:
+
+    if command in (LightCommand.AllOff, LightCommand.Mood):
+      if command == LightCommand.Mood and (command_argument is None or command_argument < 1 or command_argument > cls._MAX_MOOD):
+        raise ValueError(f'Mood must be between 1 and {cls._MAX_MOOD} inclusive, currently {command_argument}')
+      return
+
+    if udp_device_number is None or udp_device_number < 1 or udp_device_number > 15:
       raise ValueError(f'UDP Device ID must be between 1 and 15 inclusive, currently {udp_device_number}')
+    if command == LightCommand.Dim and (command_argument is None or command_argument < 0 or command_argument > cls._MAX_DIM):
+      raise ValueError(f'Dim level must be between 0 and {cls._MAX_DIM} inclusive, currently {command_argument}')
+
+
+  def _radio_message(self, udp_room_id, udp_device_number, command, command_argument=None):
+    self.validate(udp_room_id, udp_device_number, command, command_argument)
+
+    if command in (LightCommand.AllOff, LightCommand.Mood):
+      if command == LightCommand.AllOff:
+        radio_command = 0
+        radio_command_argument = self._ALL_OFF_ARGUMENT
+      else:
+        radio_command = 2
+        radio_command_argument = self._MOOD_ARGUMENT_BASE + command_argument
+      return self._build_message(udp_room_id - 1, self._ROOM_UNIT, radio_command, radio_command_argument)
 
     radio_command = command
     radio_command_argument = 0
@@ -245,9 +1651,8 @@ class Controller:
     if radio_command == 0:
       radio_command_argument = 64
 
-    message = self._build_message(udp_room_id - 1, udp_device_number - 1, radio_command, radio_command_argument)
-    self._tx.put(message, self._tx_repeat)
-  
+    return self._build_message(udp_room_id - 1, udp_device_number - 1, radio_command, radio_command_argument)
+
 
   def _build_message(self, room_id, unit_number, command, argument=0):
     arg1 = (argument & 0xF0) >> 4
@@ -0,0 +1,163 @@
+"""Diagnostics for a running daemon: a sampling profiler, started and stopped on
+   demand, and a trace of the last commands through the hub with the time each
+   reached each stage. Neither costs anything while off."""
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+
+# private to the daemon, which runs as root; systemd's StateDirectory= sets STATE_DIRECTORY
+DEFAULT_DIRECTORY = os.environ.get('STATE_DIRECTORY', '/var/lib/piwaverf')
+DEFAULT_INTERVAL = 0.01 # seconds between samples
+
+
+def _write(directory, kind, suffix, text):
+  """Writes text to a new file only the owner can read, returning its path. An existing
+     file or symlink is never written through."""
+  os.makedirs(directory, 0o700, exist_ok=True)
+  name = f'piwaverf-{kind}-{time.strftime("%Y%m%d-%H%M%S")}'
+  for attempt in range(100): # several files may be written in one second
+    unique = f'-{attempt}' if attempt else ''
+    path = os.path.join(directory, f'{name}{unique}.{suffix}')
+    try:
+      fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    except FileExistsError:
+      continue
+    with os.fdopen(fd, 'w') as fh:
+      fh.write(text)
+    return path
+  raise FileExistsError(f'Too many {kind} files named {name} in {directory}')
+
+
+class Profiler:
+  """Samples the stacks of every thread each interval seconds while running, and
+     writes them in the collapsed stack format read by flamegraph.pl and speedscope.
+     Unlike cProfile, it sees all of the hub's threads and does not slow them down
+     beyond the sampling itself."""
+
+
+  def __init__(self, directory=DEFAULT_DIRECTORY, interval=DEFAULT_INTERVAL):
+    self.directory = directory
+    self.interval = interval
+    self._samples = collections.Counter() # collapsed stack -> samples
+    self._stopping = threading.Event()
+    self._thread = None
+    self._lock = threading.Lock() # start and stop may come from signals and the control socket
+
+
+  @property
+  def running(self):
+    return self._thread is not None
+
+
+  def toggle(self):
+    """Starts profiling, or stops it and writes the profile. Returns a description."""
+    with self._lock:
+      if self._thread is None:
+        self._start()
+        return f'Profiling every {self.interval * 1000:g}ms'
+      try:
+        samples, path = self._stop()
+      except OSError as e:
+        print(f'Failed to write profile: {e}')
+        return f'Failed to write profile: {e}'
+      return f'Wrote {samples} samples to {path}'
+
+
+  def _start(self):
+    self._samples.clear()
+    self._stopping.clear()
+    self._thread = threading.Thread(target=self._run, name='piwaverf-profiler', daemon=True)
+    self._thread.start()
+    print('Profiling started')
+
+
+  def _stop(self):
+    self._stopping.set()
+    self._thread.join()
+    self._thread = None
+    path = _write(self.directory, 'profile', 'collapsed',
+                  ''.join(f'{stack} {count}\n' for stack, count in self._samples.most_common()))
+    samples = sum(self._samples.values())
+    print(f'Profiling stopped, {samples} samples written to {path}')
+    return samples, path
+
+
+  def _run(self):
+    me = threading.get_ident()
+    while not self._stopping.wait(self.interval):
+      names = {thread.ident: thread.name for thread in threading.enumerate()}
+      for ident, frame in sys._current_frames().items():
+        if ident == me:
+          continue
+        stack = []
+        while frame is not None:
+          code = frame.f_code
+          stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+          frame = frame.f_back
+        stack.append(names.get(ident, str(ident)))
+        self._samples[';'.join(reversed(stack))] += 1
+
+
+class Trace:
+  """The last size commands through the hub. Each is a record of its target and
+     function, started when the hub accepts it, to which the time.monotonic() at which
+     it reaches each later stage is added. A newer command for the same key takes over
+     from one still in progress, which is marked superseded. Thread safe."""
+
+
+  def __init__(self, size, directory=DEFAULT_DIRECTORY):
+    self.directory = directory
+    self._records = collections.deque(maxlen=size)
+    self._pending = {} # key -> record not yet finished
+    self._lock = threading.Lock()
+
+
+  def start(self, key, **fields):
+    now = time.monotonic()
+    record = {'fields': fields, 'time': time.time(), 'stages': [('accepted', now)]}
+    with self._lock:
+      previous = self._pending.get(key)
+      if previous is not None:
+        previous['stages'].append(('superseded', now))
+      self._pending[key] = record
+      self._records.append(record)
+
+
+  def stage(self, key, stage, finished=False, **fields):
+    """Adds stage, and any fields, to the command in progress for key, if any."""
+    now = time.monotonic()
+    with self._lock:
+      record = self._pending.pop(key, None) if finished else self._pending.get(key)
+      if record is not None:
+        record['stages'].append((stage, now))
+        record['fields'].update(fields)
+
+
+  def json(self):
+    """Returns the records, oldest first, with the milliseconds after acceptance at
+       which each stage was reached."""
+    with self._lock:
+      records = [(record['time'], dict(record['fields']), list(record['stages'])) for record in self._records]
+    commands = []
+    for accepted, fields, stages in records:
+      start = stages[0][1]
+      fields['time'] = round(accepted, 3)
+      fields['stages'] = {stage: round((at - start) * 1000, 3) for stage, at in stages}
+      commands.append(fields)
+    return json.dumps({'commands': commands})
+
+
+  def dump(self):
+    """Writes json() to a new file, returning its path, or None if it cannot be written."""
+    try:
+      path = _write(self.directory, 'trace', 'json', self.json() + '\n')
+    except OSError as e:
+      print(f'Failed to write trace: {e}')
+      return None
+    print(f'Wrote trace of {len(self._records)} commands to {path}')
+    return path
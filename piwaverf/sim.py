@@ -0,0 +1,413 @@
+"""An in-process stand-in for a pigpio.pi connection, for running piwaverf without a
+   Raspberry Pi. Waveforms sent on a transmit GPIO are turned into edges on any receive
+   GPIO linked to it, so a lwrf.tx can be looped back to a lwrf.rx.
+
+   The pigpio Python module is still needed for its pulse and error classes, but
+   pigpiod is not."""
+
+import heapq
+import random
+import threading
+import time
+
+import pigpio
+
+
+class VirtualClock:
+  """Time for a simulation, with the monotonic() and sleep() of the time module.
+
+     With a speed above 1 simulated time passes faster than real time. With a speed
+     of None time only moves when sleep() is called, which returns immediately."""
+
+
+  def __init__(self, speed=1.0):
+    self.speed = speed
+    self._origin = time.monotonic()
+    self._skipped = 0.0
+    self._lock = threading.Lock()
+
+
+  def monotonic(self):
+    if self.speed is None:
+      return self._skipped
+    return (time.monotonic() - self._origin) * self.speed
+
+
+  def sleep(self, seconds):
+    if seconds <= 0:
+      return
+    if self.speed is None:
+      with self._lock:
+        self._skipped += seconds
+    else:
+      time.sleep(seconds / self.speed)
+
+
+  def tick(self):
+    """The current time in microseconds, wrapping at 32 bits like pigpio's ticks."""
+    return int(self.monotonic() * 1000000) & 0xFFFFFFFF
+
+
+class _Callback:
+
+  def __init__(self, pi, gpio, edge, func):
+    self._pi = pi
+    self.gpio = gpio
+    self.edge = edge
+    self.func = func
+
+
+  def cancel(self):
+    self._pi._remove_callback(self)
+
+
+class SimulatedPi:
+  """Implements the subset of pigpio.pi used by lwrf.
+
+     links maps transmit GPIOs to the receive GPIOs that hear them. jitter is the
+     standard deviation in microseconds added to each received edge, and noise the
+     chance of a glitch being inserted after each received edge."""
+
+  MAX_WAVES = 250
+  MAX_CBS = 25016
+  MAX_CHAIN = 600
+
+
+  def __init__(self, links=None, clock=None, jitter=0, noise=0.0, seed=None):
+    self.clock = clock or VirtualClock()
+    self.connected = True
+    self._links = {}
+    for tx_gpio, rx_gpio in (links or {}).items():
+      self.link(tx_gpio, rx_gpio)
+    self._jitter = jitter
+    self._noise = noise
+    self._random = random.Random(seed)
+
+    self._levels = {}
+    self._glitch = {}
+    self._callbacks = []
+    self._pending = []
+    self._waves = {}
+    self._slots = [] # (cbs, deleted) by wave id, in pigpio's order
+    self._cbs = 0
+    self._last_cbs = 0
+    self._last_micros = 0
+    self._tx_end = 0.0
+
+    self.stats = {'waves_sent': 0, 'edges_sent': 0, 'edges_delivered': 0, 'glitches': 0}
+
+    self._lock = threading.Lock()
+    self._scheduled = []
+    self._sequence = 0
+    self._wakeup = threading.Condition(self._lock)
+    self._running = True
+    self._dispatcher = None
+    if self.clock.speed is not None:
+      self._dispatcher = threading.Thread(target=self._dispatch, name='sim-edges', daemon=True)
+      self._dispatcher.start()
+
+
+  def link(self, tx_gpio, rx_gpio):
+    self._links.setdefault(tx_gpio, set()).add(rx_gpio)
+
+
+  # GPIO
+
+  def set_mode(self, gpio, mode):
+    return 0
+
+
+  def write(self, gpio, level):
+    if self._levels.get(gpio, 0) != level:
+      self._levels[gpio] = level
+      self._transmit([(self.clock.monotonic(), {gpio: level})])
+    return 0
+
+
+  def read(self, gpio):
+    return self._levels.get(gpio, 0)
+
+
+  def set_glitch_filter(self, gpio, steady):
+    self._glitch[gpio] = steady
+    return 0
+
+
+  def set_watchdog(self, gpio, timeout):
+    return 0
+
+
+  def get_current_tick(self):
+    return self.clock.tick()
+
+
+  def callback(self, gpio, edge=pigpio.RISING_EDGE, func=None):
+    cb = _Callback(self, gpio, edge, func)
+    with self._lock:
+      self._callbacks.append(cb)
+    return cb
+
+
+  def _remove_callback(self, cb):
+    with self._lock:
+      if cb in self._callbacks:
+        self._callbacks.remove(cb)
+
+
+  def stop(self):
+    with self._lock:
+      self._running = False
+      self._wakeup.notify()
+    self.connected = False
+
+
+  # Waveforms
+
+  def wave_add_new(self):
+    self._pending = []
+    return 0
+
+
+  def wave_add_generic(self, pulses):
+    self._pending.extend(pulses)
+    return len(self._pending)
+
+
+  def wave_create(self):
+    return self.wave_create_and_pad(0)
+
+
+  def wave_create_and_pad(self, percent):
+    """As pigpio, a deleted wave's control blocks are only reused by a new wave of
+       exactly the same size, or once every wave above it is deleted too."""
+    if not self._pending:
+      return self._error(pigpio.PI_EMPTY_WAVEFORM, 'attempt to create an empty waveform')
+    cbs = 2 * len(self._pending) + 1
+    size = self.MAX_CBS * percent // 100 if percent else cbs
+    if cbs > size:
+      return self._error(pigpio.PI_TOO_MANY_CBS, 'No more CBs for waveform')
+    for wave_id, (slot_size, deleted) in enumerate(self._slots):
+      if deleted and slot_size == size:
+        break
+    else:
+      if len(self._slots) >= self.MAX_WAVES:
+        return self._error(pigpio.PI_NO_WAVEFORM_ID, 'no more waveform ids')
+      if self._cbs + size > self.MAX_CBS:
+        return self._error(pigpio.PI_TOO_MANY_CBS, 'No more CBs for waveform')
+      wave_id = len(self._slots)
+      self._slots.append(None)
+      self._cbs += size
+    self._slots[wave_id] = (size, False)
+
+    # level changes by offset in microseconds, worked out once per wave
+    changes = []
+    micros = 0
+    for pulse in self._pending:
+      levels = {}
+      mask = pulse.gpio_on | pulse.gpio_off
+      while mask:
+        bit = mask & -mask
+        levels[bit.bit_length() - 1] = 1 if pulse.gpio_on & bit else 0
+        mask ^= bit
+      if levels:
+        changes.append((micros, levels))
+      micros += pulse.delay
+
+    self._waves[wave_id] = (changes, micros, cbs)
+    self._last_cbs = cbs
+    self._last_micros = micros
+    self._pending = []
+    return wave_id
+
+
+  def wave_delete(self, wave_id):
+    if wave_id not in self._waves:
+      return self._error(pigpio.PI_BAD_WAVE_ID, 'non existent wave id')
+    del self._waves[wave_id]
+    self._slots[wave_id] = (self._slots[wave_id][0], True)
+    while self._slots and self._slots[-1][1]: # the top waves are freed
+      self._cbs -= self._slots.pop()[0]
+    return 0
+
+
+  def wave_clear(self):
+    self._waves.clear()
+    self._slots = []
+    self._pending = []
+    self._cbs = 0
+    return 0
+
+
+  def wave_get_cbs(self):
+    return self._last_cbs
+
+
+  def wave_get_max_cbs(self):
+    return self.MAX_CBS
+
+
+  def wave_get_micros(self):
+    return self._last_micros
+
+
+  def wave_send_once(self, wave_id):
+    return self.wave_chain([wave_id])
+
+
+  def wave_chain(self, data):
+    if len(data) > self.MAX_CHAIN:
+      return self._error(pigpio.PI_CHAIN_TOO_BIG, 'chain is too long')
+    try:
+      waves = self._expand_chain(list(data))
+    except KeyError:
+      return self._error(pigpio.PI_BAD_WAVE_ID, 'non existent wave id')
+
+    at = max(self.clock.monotonic(), self._tx_end)
+    changes = []
+    for item in waves:
+      if isinstance(item, int): # a delay
+        at += item / 1000000
+        continue
+      wave_changes, micros, cbs = item
+      for offset, levels in wave_changes:
+        changes.append((at + offset / 1000000, levels))
+      at += micros / 1000000
+      self.stats['waves_sent'] += 1
+
+    self._tx_end = at
+    self._transmit(changes)
+    return 0
+
+
+  def _expand_chain(self, data):
+    """Flattens a chain to a list of waves and delays in microseconds."""
+    stack = [[]]
+    i = 0
+    while i < len(data):
+      if data[i] == 255:
+        command = data[i + 1]
+        if command == 0:
+          stack.append([])
+          i += 2
+        elif command == 1:
+          count = data[i + 2] + (data[i + 3] << 8)
+          block = stack.pop()
+          stack[-1].extend(block * count)
+          i += 4
+        elif command == 2:
+          stack[-1].append(data[i + 2] + (data[i + 3] << 8))
+          i += 4
+        else:
+          raise ValueError(f'Unsupported chain command {command}')
+      else:
+        stack[-1].append(self._waves[data[i]])
+        i += 1
+    return stack[0]
+
+
+  def wave_tx_busy(self):
+    return 1 if self.clock.monotonic() < self._tx_end else 0
+
+
+  def wave_tx_stop(self):
+    now = self.clock.monotonic()
+    self._tx_end = min(self._tx_end, now)
+    with self._lock:
+      self._scheduled = [entry for entry in self._scheduled if entry[0] <= now]
+      heapq.heapify(self._scheduled)
+    return 0
+
+
+  def _error(self, code, text):
+    if pigpio.exceptions:
+      raise pigpio.error(text)
+    return code
+
+
+  # Radio
+
+  def _transmit(self, changes):
+    """Queues the GPIO level changes of a transmission for delivery to the receive
+       GPIOs linked to the GPIOs that changed."""
+    edges = []
+    for at, levels in changes:
+      for tx_gpio, level in levels.items():
+        self._levels[tx_gpio] = level
+        for rx_gpio in self._links.get(tx_gpio, ()):
+          edges.append([at, rx_gpio, level])
+    self.stats['edges_sent'] += len(edges)
+    if not edges:
+      return
+
+    if self._jitter:
+      for edge in edges:
+        edge[0] += self._random.gauss(0, self._jitter) / 1000000
+      edges.sort(key=lambda edge: edge[0])
+    if self._noise:
+      noisy = []
+      for at, gpio, level in edges:
+        noisy.append([at, gpio, level])
+        if self._random.random() < self._noise:
+          width = self._random.uniform(5, 120) / 1000000
+          noisy.append([at + width, gpio, 1 - level])
+          noisy.append([at + 2 * width, gpio, level])
+          self.stats['glitches'] += 1
+      edges = sorted(noisy, key=lambda edge: edge[0])
+    edges = self._filter_glitches(edges)
+
+    if self._dispatcher is None:
+      for at, gpio, level in edges:
+        self._deliver(at, gpio, level)
+      return
+
+    with self._lock:
+      for at, gpio, level in edges:
+        self._sequence += 1
+        heapq.heappush(self._scheduled, (at, self._sequence, gpio, level))
+      self._wakeup.notify()
+
+
+  def _filter_glitches(self, edges):
+    """Drops edges which do not stay at their level for a GPIO's glitch filter time."""
+    if not any(self._glitch.values()):
+      return edges
+    filtered = []
+    last = {}
+    for at, gpio, level in edges:
+      steady = self._glitch.get(gpio, 0) / 1000000
+      previous = last.get(gpio)
+      if previous is not None and steady and at - previous[0] < steady:
+        # the previous edge did not last, so neither it nor this one is seen
+        filtered.remove(previous)
+        last[gpio] = None
+        continue
+      edge = [at, gpio, level]
+      filtered.append(edge)
+      last[gpio] = edge
+    return filtered
+
+
+  def _dispatch(self):
+    with self._lock:
+      while self._running:
+        if not self._scheduled:
+          self._wakeup.wait()
+          continue
+        delay = self._scheduled[0][0] - self.clock.monotonic()
+        if delay > 0:
+          self._wakeup.wait(delay / self.clock.speed)
+          continue
+        at, sequence, gpio, level = heapq.heappop(self._scheduled)
+        self._lock.release()
+        try:
+          self._deliver(at, gpio, level)
+        finally:
+          self._lock.acquire()
+
+
+  def _deliver(self, at, gpio, level):
+    tick = int(at * 1000000) & 0xFFFFFFFF
+    for cb in list(self._callbacks):
+      if cb.gpio == gpio and (cb.edge == pigpio.EITHER_EDGE or cb.edge == 1 - level):
+        self.stats['edges_delivered'] += 1
+        cb.func(gpio, level, tick)
@@ -0,0 +1,309 @@
+"""Runs the transmitters of the local pigpio daemon in a process of their own, optionally
+   pinned to a CPU at real-time priority, so neither the hub's threads nor the GIL can
+   delay the start of a burst. Bursts are handed over as compact records, the message's
+   10 nibbles packed into 5 bytes, through a ring buffer in shared memory, and each
+   burst's result comes back through a second one. Neither side takes a lock: a
+   semaphore per ring is released once a burst or result is in place, so the reader
+   sleeps while there is nothing to read, and as releasing and acquiring it are memory
+   barriers the reader never sees a counter before the records it covers, even on
+   ARM."""
+
+import multiprocessing
+import os
+import signal
+import struct
+import time
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+import lwrf
+
+
+# seq, transmitter index, packed message, repeat, gap, last frame of the burst
+FRAME = struct.Struct('<HB5sHIBx')
+# seq, result as from lwrf.tx.put_interleaved(), airtime and build time in microseconds, frames,
+# and the transmitter's waveform cache hits, misses and evictions so far
+COMPLETION = struct.Struct('<HbxIIH2xIII')
+
+IDLE_WAIT = 0.5 # seconds between checks of the stop flag, or that the process is alive
+START_TIMEOUT = 10.0 # seconds allowed beyond a burst's airtime, for the process to start
+
+FAILED = -3 # put_interleaved() result when the process could not transmit at all
+
+_CONTROL = 16 # bytes before the rings, the first holding the stop flag
+
+
+@dataclass
+class TransmitProcessConfig:
+  cpu: int = None # pinned to this CPU, if given
+  priority: int = None # SCHED_FIFO priority, if given
+  connect: object = None # returns the pigpio connection, by default pigpio.pi; must be picklable
+  slots: int = 64 # records in each ring, a power of two
+
+
+class RingBuffer:
+  """A queue of fixed size records in shared memory, for one producer and one consumer.
+     Each side only ever writes its own counter, an aligned 32-bit word, so neither
+     needs a lock. Nothing orders the writes to the records and counters, so the
+     consumer must only read what the producer has signalled, as by a semaphore."""
+
+  _COUNTER = struct.Struct('<I')
+
+
+  def __init__(self, buffer, offset, slots, size):
+    if slots < 1 or slots & (slots - 1):
+      raise ValueError(f'Ring buffer slots must be a power of two, found: {slots}')
+    self._buffer = buffer
+    self._head = offset # written by the producer
+    self._tail = offset + 4 # written by the consumer
+    self._records = offset + 8
+    self._slots = slots
+    self._size = size
+
+
+  @staticmethod
+  def nbytes(slots, size):
+    return 8 + slots * size
+
+
+  def put(self, record):
+    """Appends a record, returning False if the ring is full."""
+    head = self._load(self._head)
+    if (head - self._load(self._tail)) & 0xFFFFFFFF >= self._slots:
+      return False
+    start = self._records + (head & (self._slots - 1)) * self._size
+    self._buffer[start:start + self._size] = record
+    self._store(self._head, (head + 1) & 0xFFFFFFFF) # only once the record is in place
+    return True
+
+
+  def get(self):
+    """Removes and returns the oldest record, or None if the ring is empty."""
+    tail = self._load(self._tail)
+    if tail == self._load(self._head):
+      return None
+    start = self._records + (tail & (self._slots - 1)) * self._size
+    record = bytes(self._buffer[start:start + self._size])
+    self._store(self._tail, (tail + 1) & 0xFFFFFFFF)
+    return record
+
+
+  def reset(self):
+    """Empties the ring, only while neither side is using it."""
+    self._store(self._head, 0)
+    self._store(self._tail, 0)
+
+
+  def _load(self, offset):
+    return self._COUNTER.unpack_from(self._buffer, offset)[0]
+
+
+  def _store(self, offset, value):
+    self._COUNTER.pack_into(self._buffer, offset, value)
+
+
+def _rings(buffer, slots):
+  frames = RingBuffer(buffer, _CONTROL, slots, FRAME.size)
+  completions = RingBuffer(buffer, _CONTROL + RingBuffer.nbytes(slots, FRAME.size), slots, COMPLETION.size)
+  return frames, completions
+
+
+def _pack(data):
+  return bytes((data[i] << 4) | data[i + 1] for i in range(0, lwrf.MESSAGE_BYTES, 2))
+
+
+def _unpack(packed):
+  data = bytearray(lwrf.MESSAGE_BYTES)
+  for i, byte in enumerate(packed):
+    data[2 * i] = byte >> 4
+    data[2 * i + 1] = byte & 0xF
+  return data
+
+
+class TransmitProcess:
+  """The parent's side of a transmit process for transmitters on gpios of the local
+     pigpio daemon. The process is started on first use and restarted if it exits.
+     Not thread safe."""
+
+
+  def __init__(self, gpios, config=None):
+    self._gpios = list(gpios)
+    self._config = config if config is not None else TransmitProcessConfig()
+    slots = self._config.slots
+    self._memory = shared_memory.SharedMemory(
+      create=True, size=_CONTROL + RingBuffer.nbytes(slots, FRAME.size) + RingBuffer.nbytes(slots, COMPLETION.size))
+    self._frames, self._completions = _rings(self._memory.buf, slots)
+    self._context = multiprocessing.get_context('spawn') # forking a threaded hub is unsafe
+    self._burst_ready = self._context.Semaphore(0) # released once for each burst in the frames ring
+    self._completed = self._context.Semaphore(0) # released once for each completion
+    self._process = None
+    self._sequence = 0
+
+
+  def tx(self, index):
+    """Returns the stand-in for lwrf.tx of the transmitter on the index'th gpio."""
+    return ProcessTx(self, index)
+
+
+  def put(self, index, frames):
+    """Transmits (message, repeat, gap) frames as one burst, returning once it has
+       finished with the result of lwrf.tx.put_interleaved(), or FAILED, the seconds
+       on air, seconds building waveforms and frames sent, and the transmitter's
+       (hits, misses, evictions) cache counters, or None if it could not transmit."""
+    if not frames or len(frames) > self._config.slots:
+      return -1, 0.0, 0.0, 0, None
+    if self._process is None or not self._process.is_alive():
+      self._start()
+    self._sequence = (self._sequence + 1) & 0xFFFF
+    for i, (data, repeat, gap) in enumerate(frames):
+      self._frames.put(FRAME.pack(self._sequence, index, _pack(data), repeat, gap, i == len(frames) - 1))
+    self._burst_ready.release()
+
+    airtime = (lwrf.TX_GAP + sum(repeat * lwrf.tx.micros(data, gap) for data, repeat, gap in frames)) / 1000000
+    deadline = time.monotonic() + airtime + START_TIMEOUT
+    while True:
+      if self._completed.acquire(timeout=IDLE_WAIT):
+        record = self._completions.get()
+        if record is not None:
+          sequence, result, micros, build_micros, sent, *cache = COMPLETION.unpack(record)
+          if sequence == self._sequence:
+            return result, micros / 1000000, build_micros / 1000000, sent, cache if result != FAILED else None
+        continue # left from a burst which timed out
+      if not self._process.is_alive():
+        print(f'Transmit process exited with code {self._process.exitcode}')
+        return FAILED, 0.0, 0.0, 0, None
+      if time.monotonic() > deadline:
+        print('Transmit process is not responding, restarting it')
+        self._process.terminate()
+        self._process.join()
+        return FAILED, 0.0, 0.0, 0, None
+
+
+  def stop(self):
+    """Stops the process, after any burst in progress, and frees the shared memory."""
+    if self._process is not None:
+      self._memory.buf[0] = 1
+      self._burst_ready.release()
+      self._process.join(START_TIMEOUT)
+      if self._process.is_alive():
+        self._process.terminate()
+        self._process.join()
+      self._process = None
+    self._frames = self._completions = None
+    self._memory.close()
+    self._memory.unlink()
+
+
+  def _start(self):
+    if self._process is not None:
+      self._process.join()
+    self._memory.buf[0] = 0
+    self._frames.reset()
+    self._completions.reset()
+    self._process = self._context.Process(target=_serve, name='piwaverf-tx-process', daemon=True,
+                                          args=(self._memory.name, self._gpios, self._config,
+                                                self._burst_ready, self._completed))
+    self._process.start()
+    print(f'Started transmit process {self._process.pid} for GPIO{", GPIO".join(str(gpio) for gpio in self._gpios)}')
+
+
+class ProcessTx:
+  """Stands in for the lwrf.tx of one transmitter run by a TransmitProcess, as far as
+     the Controller uses it."""
+
+
+  def __init__(self, process, index):
+    self._process = process
+    self._index = index
+    self.lastBuildTime = 0.0
+    self.lastAirTime = 0.0
+    self.lastFrames = 0
+    self.cacheHits = 0 # as last reported by the process
+    self.cacheMisses = 0
+    self.cacheEvictions = 0
+
+
+  def put_interleaved(self, frames):
+    result, self.lastAirTime, self.lastBuildTime, self.lastFrames, cache = self._process.put(self._index, frames)
+    if cache is not None:
+      self.cacheHits, self.cacheMisses, self.cacheEvictions = cache
+    return result
+
+
+  def cancel(self):
+    pass # the process finishes any burst in progress when stopped
+
+
+def _serve(name, gpios, config, burst_ready, completed):
+  """The transmit process: sends each burst from the frames ring, and reports it."""
+  # Ctrl-C and the hub's diagnostic signals may reach the whole group; the hub stops us
+  for sig in (signal.SIGINT, signal.SIGUSR1, signal.SIGUSR2):
+    signal.signal(sig, signal.SIG_IGN)
+  memory = shared_memory.SharedMemory(name)
+  frames_ring, completions = _rings(memory.buf, config.slots)
+  _prioritise(config.cpu, config.priority)
+  pi = None
+  transmitters = []
+  parent = os.getppid()
+  try:
+    while not memory.buf[0]:
+      if not burst_ready.acquire(timeout=IDLE_WAIT):
+        if os.getppid() != parent:
+          break # the hub was killed without stopping us
+        continue
+      frames = []
+      last = False
+      while not last:
+        record = frames_ring.get()
+        if record is None:
+          break # released for stopping, or left from a process which exited
+        sequence, index, packed, repeat, gap, last = FRAME.unpack(record)
+        frames.append((_unpack(packed), repeat, gap))
+      if not last:
+        continue
+
+      try:
+        if pi is None:
+          pi = (config.connect or lwrf.pigpio.pi)()
+          if not getattr(pi, 'connected', True):
+            raise RuntimeError('cannot connect to pigpiod')
+          pi.wave_clear() # anything left by an earlier transmit process
+          clock = getattr(pi, 'clock', time)
+          transmitters = [lwrf.tx(pi, gpio, clock=clock, shared_by=len(gpios)) for gpio in gpios]
+        tx = transmitters[index]
+        result = tx.put_interleaved(frames)
+        completion = COMPLETION.pack(sequence, result, round(tx.lastAirTime * 1000000),
+                                     round(tx.lastBuildTime * 1000000), tx.lastFrames,
+                                     tx.cacheHits, tx.cacheMisses, tx.cacheEvictions)
+      except Exception as e:
+        print(f'Transmit process failed to send: {e}')
+        if pi is not None:
+          try:
+            pi.stop()
+          except Exception:
+            pass
+        pi = None # reconnect for the next burst
+        transmitters = []
+        completion = COMPLETION.pack(sequence, FAILED, 0, 0, 0, 0, 0, 0)
+      completions.put(completion)
+      completed.release()
+  finally:
+    for tx in transmitters:
+      tx.cancel()
+    if pi is not None:
+      pi.stop()
+    frames_ring = completions = None
+    memory.close()
+
+
+def _prioritise(cpu, priority):
+  if cpu is not None:
+    try:
+      os.sched_setaffinity(0, {cpu})
+    except (AttributeError, OSError) as e:
+      print(f'Cannot pin the transmit process to CPU {cpu}: {e}')
+  if priority is not None:
+    try:
+      os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (AttributeError, OSError) as e:
+      print(f'Cannot give the transmit process real-time priority {priority}: {e}')